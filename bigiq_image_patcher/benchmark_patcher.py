@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,line-too-long
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module benchmarks the image patcher against small synthetic qcow2
+disk images laid out with BIG-IQ like LVM volumes. Each payload size is
+patched through the real extract, inspect, inject, digest and sign code
+paths and the per stage timings of the run reports are compared.
+
+usage: benchmark_patcher.py <work directory> [file count ...]
+"""
+
+import os
+import sys
+import json
+import shutil
+import zipfile
+
+import guestfs
+
+from Crypto.PublicKey import RSA
+
+import bigiq_image_patcher
+
+DEFAULT_FILE_COUNTS = [10, 100, 1000]
+DISK_SIZE = 512 * 1024 * 1024
+VOLUME_GROUP = 'vg-db-sda'
+LOGICAL_VOLUMES = [('set.1._config', 64), ('set.1._usr', 160),
+                   ('set.1._var', 160), ('dat.share.1', 64)]
+PAYLOAD_TREES = ['config', 'usr', 'var', 'shared']
+PAYLOAD_FILE_SIZE = 4096
+PAYLOAD_FILES_PER_DIR = 100
+BENCHMARK_IMAGE = 'BIG-IQ-benchmark.qcow2'
+BENCHMARK_REPORT_FILE = 'benchmark_report.json'
+
+
+def create_disk_image(disk_image):
+    """Create a qcow2 disk image with BIG-IQ like LVM file systems"""
+    gfs = guestfs.GuestFS(python_return_dict=True)
+    gfs.disk_create(disk_image, 'qcow2', DISK_SIZE)
+    gfs.add_drive_opts(disk_image, format='qcow2')
+    gfs.launch()
+    gfs.part_disk('/dev/sda', 'mbr')
+    gfs.pvcreate('/dev/sda1')
+    gfs.vgcreate(VOLUME_GROUP, ['/dev/sda1'])
+    for (lv_name, lv_size) in LOGICAL_VOLUMES:
+        gfs.lvcreate(lv_name, VOLUME_GROUP, lv_size)
+        gfs.mkfs('ext4', "/dev/%s/%s" % (VOLUME_GROUP, lv_name))
+    gfs.shutdown()
+    gfs.close()
+
+
+def create_payload(payload_dir, file_count):
+    """Create injection trees holding file_count files between them"""
+    payload_dirs = {}
+    for index, tree in enumerate(PAYLOAD_TREES):
+        tree_dir = os.path.join(payload_dir, tree)
+        payload_dirs[tree] = tree_dir
+        tree_files = file_count // len(PAYLOAD_TREES)
+        if index < file_count % len(PAYLOAD_TREES):
+            tree_files += 1
+        for file_index in range(tree_files):
+            file_dir = os.path.join(
+                tree_dir, 'benchmark',
+                "%03d" % (file_index // PAYLOAD_FILES_PER_DIR))
+            if not os.path.exists(file_dir):
+                os.makedirs(file_dir)
+            with open(os.path.join(file_dir, "file-%05d" % file_index),
+                      'wb') as payload_file:
+                payload_file.write(os.urandom(PAYLOAD_FILE_SIZE))
+    return payload_dirs
+
+
+def create_signing_key(key_path):
+    """Create an RSA private key to sign the benchmark images with"""
+    with open(key_path, 'wb') as key_file:
+        key_file.write(RSA.generate(2048).exportKey('PEM'))
+
+
+def run_benchmark(work_dir, disk_image, key_path, file_count):
+    """Patch an archive of the disk image, returning the run report"""
+    run_dir = os.path.join(work_dir, "files-%d" % file_count)
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    image_dir = os.path.join(run_dir, 'images')
+    os.makedirs(image_dir)
+    payload_dirs = create_payload(os.path.join(run_dir, 'payload'),
+                                  file_count)
+    with zipfile.ZipFile(os.path.join(image_dir,
+                                      "%s.zip" % BENCHMARK_IMAGE),
+                         'w') as archive:
+        archive.write(disk_image, BENCHMARK_IMAGE)
+    results = bigiq_image_patcher.patch_images(
+        image_dir, None, payload_dirs['usr'], payload_dirs['var'],
+        payload_dirs['config'], payload_dirs['shared'], key_path, None, True,
+        None)
+    for (image, success, error) in results:
+        if not success:
+            raise Exception("patching %s failed: %s" % (image, error))
+    with open(os.path.join(image_dir, bigiq_image_patcher.RUN_REPORT_FILE),
+              'r') as report_file:
+        return json.load(report_file)
+
+
+def benchmark(work_dir, file_counts):
+    """Run the benchmark for every payload size and return the reports"""
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    os.environ['UPDATE_CLOUDINIT'] = 'false'
+    disk_image = os.path.join(work_dir, BENCHMARK_IMAGE)
+    if not os.path.exists(disk_image):
+        create_disk_image(disk_image)
+    key_path = os.path.join(work_dir, 'benchmark.pem')
+    if not os.path.exists(key_path):
+        create_signing_key(key_path)
+    reports = {}
+    for file_count in file_counts:
+        reports[file_count] = run_benchmark(work_dir, disk_image, key_path,
+                                            file_count)
+    with open(os.path.join(work_dir, BENCHMARK_REPORT_FILE),
+              'w') as report_file:
+        json.dump(reports, report_file, indent=2)
+    return reports
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: %s <work directory> [file count ...]" % sys.argv[0])
+        sys.exit(1)
+    WORK_DIR = sys.argv[1]
+    FILE_COUNTS = [int(count) for count in sys.argv[2:]
+                   ] or DEFAULT_FILE_COUNTS
+    REPORTS = benchmark(WORK_DIR, FILE_COUNTS)
+    STAGES = []
+    for FILE_COUNT in FILE_COUNTS:
+        for STAGE in REPORTS[FILE_COUNT]['stages']:
+            if STAGE not in STAGES:
+                STAGES.append(STAGE)
+    print("%-36s" % 'stage' +
+          ''.join(["%14s" % ("%d files" % count) for count in FILE_COUNTS]))
+    for STAGE in STAGES + ['total']:
+        ROW = "%-36s" % STAGE
+        for FILE_COUNT in FILE_COUNTS:
+            REPORT = REPORTS[FILE_COUNT]
+            if STAGE == 'total':
+                ROW += "%14.3f" % REPORT['seconds']
+            elif STAGE in REPORT['stages']:
+                ROW += "%14.3f" % REPORT['stages'][STAGE]['seconds']
+            else:
+                ROW += "%14s" % '-'
+        print(ROW)
@@ -25,32 +25,118 @@ import os
 import sys
 import tarfile
 import zipfile
+import ctypes
+import ctypes.util
 import datetime
+import errno
+import fcntl
 import hashlib
+import json
 import time
 import logging
+import multiprocessing
+import queue
+import threading
 import subprocess
+import tempfile
 import guestfs
 import re
+import shutil
+import stat
+import struct
 
 from Crypto.Hash import SHA384
 from Crypto.Signature import PKCS1_v1_5
+from Crypto.Signature import PKCS1_PSS
 from Crypto.PublicKey import RSA
 
 ARCHIVE_EXTS = {'.zip': 'zipfile', '.ova': 'tarfile'}
 IMAGE_TYPES = ['.qcow2', '.vhd', '.vmdk']
+EXTRACT_MEMBER_TYPES = IMAGE_TYPES + ['.ovf']
+EXTRACT_BLOCK_SIZE = 8 * 1024 * 1024
 
 VBOXMANAGE_CLI = '/usr/bin/vboxmanage'
 VBOXMANAGE_CLI_FORMAT = 'vmdk'
 VBOXMANAGE_CLI_PATCH_VARIANT = 'Standard'
 VBOXMANAGE_CLI_OUTPUT_VARIANT = 'Stream'
 
+QEMU_IMG_CLI = '/usr/bin/qemu-img'
+QEMU_IMG_FORMATS = {'.qcow2': 'qcow2', '.vhd': 'vpc', '.vmdk': 'vmdk'}
+QEMU_IMG_VMDK_SUBFORMATS = {
+    'Standard': 'monolithicSparse',
+    'Stream': 'streamOptimized'
+}
+QEMU_IMG_COROUTINES = 8
+
+VMDK_CONVERTER = 'vboxmanage'
+
+PROGRESS_LOG_INTERVAL = 10
+PROGRESS_WATCH_INTERVAL = 1
+PROGRESS_JSON_FILE = None
+
+OVA_BLOCK_SIZE = 8 * 1024 * 1024
+OVA_MANIFEST_DIGEST = 'sha256'
+FALLOC_FL_INSERT_RANGE = 0x20
+
+OVERLAY_MODE = False
+OVERLAY_EXT = '.overlay'
+OVERLAY_BASE_DIR = '.overlay_base'
+
+INJECT_MODE = 'tar'
+CLOUDINIT_TEMPLATE_DIR = '/share/defaults/config/templates'
+REPATCH_IMAGE_TYPES = ['.qcow2', '.vhd']
+MOUNT_FILE_SYSTEMS = {
+    '/config': 'config',
+    '/usr': 'usr',
+    '/var': 'var',
+    '/shared': 'shared'
+}
+
+SIGNATURE_EXT = '.384.sig'
+SIGNATURE_SCHEMES = {'pkcs1': PKCS1_v1_5, 'pss': PKCS1_PSS}
+SIGNATURE_SCHEME = 'pkcs1'
+
+MANIFEST_EXTS = [
+    '.manifest', '.manifest.json',
+    '.manifest%s' % SIGNATURE_EXT, '.manifest.json%s' % SIGNATURE_EXT
+]
+MANIFEST_JSON = False
+
+PATCH_CACHE_ARCHIVE_INDEX = 'archives.json'
+PATCH_CACHE_KEY_FILE = '.patch_key'
+
+RUN_REPORT_FILE = 'patch_report.json'
+PLAN_FILE = 'patch_plan.json'
+
+INSPECT_CACHE_FILE = '.inspect_cache.json'
+INSPECT_HEADER_SIZE = 1024 * 1024
+SECTOR_SIZE = 512
+VHD_COOKIE = b'conectix'
+VHD_FIXED_DISK = 2
+LVM_LABEL_SECTORS = 4
+LVM_MDA_HEADER_SIZE = 512
+
+GFS_SETTLE_TIMEOUT = 30
+GFS_SETTLE_MIN_DELAY = 0.05
+GFS_SETTLE_MAX_DELAY = 1.0
+
+DIGEST_BLOCK_SIZE = 8 * 1024 * 1024
+DIGEST_QUEUE_DEPTH = 4
+
+# workers are started from a clean server process, never forked from the
+# threaded pipeline, and get the settings below passed explicitly
+PATCH_POOL_START_METHOD = 'forkserver'
+WORKER_CONFIG_NAMES = [
+    'INJECT_MODE', 'MANIFEST_JSON', 'OVERLAY_MODE', 'VMDK_CONVERTER',
+    'PROGRESS_JSON_FILE', 'QEMU_IMG_COROUTINES', 'SIGNATURE_SCHEME'
+]
+
 DEBUG = True
 
 LOG = logging.getLogger('bigiq_image_patcher')
 LOG.setLevel(logging.DEBUG)
 FORMATTER = logging.Formatter(
-    '%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    '%(asctime)s - %(name)s - %(threadName)s - %(levelname)s - %(message)s')
 LOGSTREAM = logging.StreamHandler(sys.stdout)
 LOGSTREAM.setFormatter(FORMATTER)
 LOG.addHandler(LOGSTREAM)
@@ -59,70 +145,805 @@ LOG.addHandler(LOGSTREAM)
 def patch_images(bigiq_image_dir, bigiq_cloudinit_dir, bigiq_usr_inject_dir,
                  bigiq_var_inject_dir, bigiq_config_inject_dir,
                  bigiq_shared_inject_dir, private_pem_key_path,
-                 cloud_template_file, image_overwrite, image_build_id):
-    """Patch BIGIQ classic disk image"""
+                 cloud_template_file, image_overwrite, image_build_id,
+                 patch_workers=1, digest_algorithms=None,
+                 patch_cache_dir=None, dry_run=False, patch_batch_size=1,
+                 incremental=False):
+    """Patch BIGIQ classic disk image
+
+    With dry_run set the patch plan is written to the image directory
+    and an empty result list is returned without patching any image or
+    consulting the patch cache.
+    With a patch_batch_size above one, disk images are extracted and
+    converted first, then patched in batches sharing an appliance.
+    With incremental set, previously patched images are updated in place
+    from their JSON manifests instead of being skipped.
+    """
     if bigiq_image_dir and os.path.exists(bigiq_image_dir):
-        for disk_image in scan_for_images(bigiq_image_dir, image_overwrite,
-                                          image_build_id):
-            (is_bigiq, config_dev, usr_dev, var_dev, shared_dev) = \
-                validate_bigiq_device(disk_image)
-            if is_bigiq:
-                manifest_file_path = "%s.manifest" % disk_image
-                if os.path.exists(manifest_file_path):
-                    LOG.info('deleting previous manifest file %s',
-                             manifest_file_path)
-                    os.unlink(manifest_file_path)
-                if usr_dev and bigiq_cloudinit_dir:
-                    update_cloudinit = os.getenv('UPDATE_CLOUDINIT',
-                                                 default="true")
-                    if update_cloudinit == "true":
-                        update_cloudinit_modules(bigiq_cloudinit_dir)
-                    inject_cloudinit_modules(disk_image, bigiq_cloudinit_dir,
-                                             usr_dev)
-                if usr_dev and cloud_template_file:
-                    inject_cloudinit_config_template(disk_image,
-                                                     bigiq_cloudinit_dir,
-                                                     cloud_template_file,
-                                                     usr_dev)
-                if usr_dev and bigiq_usr_inject_dir:
-                    inject_usr_files(disk_image, bigiq_usr_inject_dir, usr_dev)
-                if var_dev and bigiq_var_inject_dir:
-                    inject_var_files(disk_image, bigiq_var_inject_dir, var_dev)
-                if shared_dev and bigiq_shared_inject_dir:
-                    inject_shared_files(disk_image, bigiq_shared_inject_dir,
-                                        shared_dev)
-                if config_dev and bigiq_config_inject_dir:
-                    inject_config_files(disk_image, bigiq_config_inject_dir,
-                                        config_dev)
-                if os.path.splitext(disk_image)[1] == '.vmdk':
-                    clean_up_vmdk(disk_image)
-            generate_md5sum(disk_image)
-            if private_pem_key_path:
-                try:
-                    sign_image(disk_image, private_pem_key_path)
-                except Exception as ex:
-                    LOG.error("could not sign %s with private key %s: %s",
-                              disk_image, private_pem_key_path, ex)
-            if image_build_id:
-                build_split = os.path.splitext(disk_image)
-                build_name = "%s-%s%s" % (build_split[0], image_build_id, build_split[1])
-                os.rename(disk_image, build_name)
-                os.rename("%s.md5" % disk_image, "%s.md5" % build_name)
-                os.rename("%s.manifest" % disk_image, "%s.manifest" % build_name)
-                sig_file = "%s.384.sig" % disk_image
-                if os.path.exists(sig_file):
-                    os.rename(sig_file, "%s.384.sig" % build_name)
+        if not dry_run and bigiq_cloudinit_dir and \
+                os.getenv('UPDATE_CLOUDINIT', default="true") == "true":
+            update_cloudinit_modules(bigiq_cloudinit_dir)
+        signer = None
+        if private_pem_key_path:
+            try:
+                signer = ImageSigner(private_pem_key_path)
+            except Exception as ex:
+                LOG.error("could not load private key %s: %s",
+                          private_pem_key_path, ex)
+        patch_cache = None
+        # a dry run must not create the cache or read whole archives to
+        # compute cache keys
+        if patch_cache_dir and not dry_run:
+            inject_dirs = []
+            if bigiq_cloudinit_dir:
+                inject_dirs.append(
+                    "%s/image_patch_files/system_python_path" %
+                    bigiq_cloudinit_dir)
+            inject_dirs = inject_dirs + [
+                bigiq_usr_inject_dir, bigiq_var_inject_dir,
+                bigiq_config_inject_dir, bigiq_shared_inject_dir
+            ]
+            settings = {
+                'signing_key': signer.fingerprint if signer else None,
+                'signature_scheme': signer.scheme if signer else None,
+                'image_digests': sorted(digest_algorithms or []),
+                'manifest_json': MANIFEST_JSON,
+                'inject_mode': INJECT_MODE,
+                'overlay_mode': OVERLAY_MODE
+            }
+            patch_cache = PatchCache(patch_cache_dir, inject_dirs,
+                                     cloud_template_file, image_build_id,
+                                     settings)
+        start_time = time.time()
+        plan = plan_patch(bigiq_image_dir, bigiq_cloudinit_dir,
+                          bigiq_usr_inject_dir, bigiq_var_inject_dir,
+                          bigiq_config_inject_dir, bigiq_shared_inject_dir,
+                          cloud_template_file, image_overwrite,
+                          image_build_id, patch_cache, dry_run, incremental)
+        if dry_run:
+            write_plan(bigiq_image_dir, plan)
+            return []
+        injections = plan['injections']
+        inspect_cache_path = os.path.join(bigiq_image_dir, INSPECT_CACHE_FILE)
+        pool = None
+        config = worker_config()
+        if patch_workers > 1:
+            LOG.info('patching images with %d worker processes',
+                     patch_workers)
+            pool = multiprocessing.get_context(PATCH_POOL_START_METHOD).Pool(
+                processes=patch_workers, maxtasksperchild=1)
+
+        def patch_stage(disk_image):
+            patch_args = (disk_image, injections, inspect_cache_path)
+            if pool:
+                return (disk_image,
+                        pool.apply(patch_image_worker, (patch_args, config)))
+            return (disk_image, patch_image(*patch_args))
+
+        def patch_batch_stage(disk_images):
+            patch_args = (disk_images, injections, inspect_cache_path)
+            if pool:
+                return pool.apply(patch_batch_worker, (patch_args, config))
+            return patch_image_batch(*patch_args)
+
+        def repatch_stage(disk_image):
+            repatch_args = (disk_image, injections, inspect_cache_path)
+            if pool:
+                return pool.apply(repatch_image_worker,
+                                  (repatch_args, config))
+            return repatch_image(*repatch_args)
+
+        def finalize_stage(packaged_image):
+            return (finalize_image(packaged_image, signer,
+                                   image_build_id, digest_algorithms), True,
+                    None)
+
+        prepare_stages = [
+            ('extract', lambda archive: extract_images(*archive), 1),
+            ('convert', prepare_image, 1),
+        ]
+        output_stages = [
+            ('package', lambda patched: package_image(*patched), 1),
+            ('finalize', finalize_stage, 1),
+        ]
+        try:
+            if patch_batch_size > 1:
+                prepared = StagedPipeline(prepare_stages).run(
+                    plan['archives'])
+                results = [
+                    result for result in prepared
+                    if not isinstance(result, str)
+                ]
+                disk_images = sorted([
+                    result for result in prepared if isinstance(result, str)
+                ])
+                batches = [
+                    disk_images[index:index + patch_batch_size]
+                    for index in range(0, len(disk_images), patch_batch_size)
+                ]
+                LOG.info('patching %d images in %d batches',
+                         len(disk_images), len(batches))
+                results = results + StagedPipeline(
+                    [('patch', patch_batch_stage, patch_workers)] +
+                    output_stages).run(batches)
+            else:
+                results = StagedPipeline(
+                    prepare_stages + [('patch', patch_stage, patch_workers)] +
+                    output_stages).run(plan['archives'])
+            if plan['repatch_images']:
+                results = results + StagedPipeline([
+                    ('repatch', repatch_stage, patch_workers),
+                    ('finalize', finalize_stage, 1),
+                ]).run(plan['repatch_images'])
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        log_patch_summary(results)
+        write_run_report(bigiq_image_dir, results, start_time)
+        if patch_cache:
+            patch_cache.store_results(results)
+        return results
     else:
         LOG.error("BIGIQ image directory %s does not exist.", bigiq_image_dir)
         LOG.error("Set environment variable BIGIQ_IMAGE_DIR or supply as the first argument to the script.")
         sys.exit(1)
 
 
-def scan_for_images(tmos_image_dir, image_overwrite, image_build_id):
+class StagedPipeline(object):
+    """Run work items through ordered stages, each with its own worker queue
+
+    A stage is a (name, function, workers) tuple. The stage function
+    receives one item and returns the next item, a list of items or None
+    to drop the item. Items leaving the last stage are collected as
+    results. An item failing in any stage is collected as an
+    (item name, False, error) result, the item name being the item
+    itself or its first element. A failing list of items, such as a
+    batch of disk images, is collected as one result per item.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+
+    def run(self, items):
+        """Push items through every stage and return the collected results"""
+        stage_queues = [queue.Queue() for stage in self.stages]
+        results = []
+        results_lock = threading.Lock()
+
+        def collect(result):
+            with results_lock:
+                results.append(result)
+
+        def work(index):
+            (stage_name, stage_function, workers) = self.stages[index]
+            while True:
+                item = stage_queues[index].get()
+                if item is None:
+                    return
+                item_name = item if isinstance(item, str) else item[0]
+                threading.current_thread().name = "%s:%s" % (
+                    stage_name, os.path.basename(item_name))
+                try:
+                    output = stage_function(item)
+                except Exception as ex:
+                    LOG.error('%s stage failed for %s: %s', stage_name,
+                              item_name, ex)
+                    for failed_item in (item if isinstance(item, list) else
+                                        [item]):
+                        collect((failed_item if isinstance(failed_item, str)
+                                 else failed_item[0], False, str(ex)))
+                    continue
+                if output is None:
+                    continue
+                if not isinstance(output, list):
+                    output = [output]
+                for next_item in output:
+                    if index + 1 < len(self.stages):
+                        stage_queues[index + 1].put(next_item)
+                    else:
+                        collect(next_item)
+
+        stage_threads = []
+        for index, (stage_name, stage_function, workers) in \
+                enumerate(self.stages):
+            threads = []
+            for worker in range(max(workers, 1)):
+                thread = threading.Thread(target=work,
+                                          args=(index, ),
+                                          name="%s-%d" % (stage_name, worker))
+                thread.start()
+                threads.append(thread)
+            stage_threads.append(threads)
+        for item in items:
+            stage_queues[0].put(item)
+        for index, threads in enumerate(stage_threads):
+            for thread in threads:
+                stage_queues[index].put(None)
+            for thread in threads:
+                thread.join()
+        return results
+
+
+def worker_config():
+    """Return the module settings worker processes must patch with"""
+    return dict([(name, globals()[name]) for name in WORKER_CONFIG_NAMES])
+
+
+def apply_worker_config(config):
+    """Apply module settings passed from the parent process"""
+    globals().update(config)
+
+
+def patch_image_worker(patch_args, config):
+    """Process pool entry point patching a single disk image"""
+    apply_worker_config(config)
+    threading.current_thread().name = "patch:%s" % os.path.basename(
+        patch_args[0])
+    return patch_image(*patch_args)
+
+
+def repatch_image_worker(repatch_args, config):
+    """Process pool entry point incrementally patching a disk image"""
+    apply_worker_config(config)
+    threading.current_thread().name = "repatch:%s" % os.path.basename(
+        repatch_args[0])
+    return repatch_image(*repatch_args)
+
+
+def patch_batch_worker(patch_args, config):
+    """Process pool entry point patching a batch of disk images"""
+    apply_worker_config(config)
+    threading.current_thread().name = "patch:%s" % os.path.basename(
+        patch_args[0][0])
+    return patch_image_batch(*patch_args)
+
+
+def report_path(disk_image):
+    """Return the path of the per image JSON stage report"""
+    return "%s.report.json" % disk_image
+
+
+def start_report(disk_image):
+    """Remove the stage report left by a previous run of a disk image"""
+    if os.path.exists(report_path(disk_image)):
+        os.unlink(report_path(disk_image))
+
+
+def record_stage(disk_image, stage, start_time, byte_count=0, file_count=0,
+                 **details):
+    """Append a stage timing record to the disk image JSON report"""
+    stage_record = {
+        'stage': stage,
+        'start': round(start_time, 3),
+        'seconds': round(time.time() - start_time, 3),
+        'bytes': byte_count,
+        'files': file_count
+    }
+    stage_record.update(details)
+    LOG.debug('stage %s for %s took %.3f seconds', stage, disk_image,
+              stage_record['seconds'])
+    report = {'image': disk_image, 'stages': []}
+    if os.path.exists(report_path(disk_image)):
+        with open(report_path(disk_image), 'r') as report_file:
+            report = json.load(report_file)
+    report['stages'].append(stage_record)
+    report_tmp_path = "%s.tmp" % report_path(disk_image)
+    with open(report_tmp_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    os.rename(report_tmp_path, report_path(disk_image))
+
+
+def write_run_report(bigiq_image_dir, results, start_time):
+    """Aggregate the per image reports of a run into a JSON run report"""
+    run_report = {
+        'start': round(start_time, 3),
+        'seconds': round(time.time() - start_time, 3),
+        'images': [],
+        'stages': {}
+    }
+    for (disk_image, success, error) in results:
+        image_report = {'image': disk_image, 'success': success,
+                        'error': error, 'stages': []}
+        if os.path.exists(report_path(disk_image)):
+            with open(report_path(disk_image), 'r') as report_file:
+                image_report['stages'] = json.load(report_file)['stages']
+        for stage_record in image_report['stages']:
+            totals = run_report['stages'].setdefault(
+                stage_record['stage'], {
+                    'count': 0,
+                    'seconds': 0,
+                    'bytes': 0,
+                    'files': 0
+                })
+            totals['count'] += 1
+            totals['seconds'] = round(
+                totals['seconds'] + stage_record['seconds'], 3)
+            totals['bytes'] += stage_record['bytes']
+            totals['files'] += stage_record['files']
+        run_report['images'].append(image_report)
+    run_report_path = os.path.join(bigiq_image_dir, RUN_REPORT_FILE)
+    with open(run_report_path, 'w') as report_file:
+        json.dump(run_report, report_file, indent=2)
+    LOG.info('wrote run report %s', run_report_path)
+    return run_report
+
+
+def log_patch_summary(results):
+    """Log the per image success or failure of a patching run"""
+    failed = [result for result in results if not result[1]]
+    LOG.info('patched %d of %d images', len(results) - len(failed),
+             len(results))
+    for (disk_image, success, error) in results:
+        if success:
+            LOG.info('  %s: success', disk_image)
+        else:
+            LOG.error('  %s: failed - %s', disk_image, error)
+
+
+def patch_image(disk_image, injections, inspect_cache_path=None):
+    """Inject files into a single BIGIQ disk image, returning is_bigiq
+
+    The BIG-IQ file systems are taken from the inspection cache or read
+    from the LVM metadata on disk when possible. The appliance is then
+    only launched to discover file systems when neither is available,
+    and not at all for a disk image known not to be a BIG-IQ image.
+    """
+    patch_target = disk_image
+    overlay_image = "%s%s" % (disk_image, OVERLAY_EXT)
+    if os.path.exists(overlay_image):
+        patch_target = overlay_image
+    start_time = time.time()
+    inspect_cache = None
+    inspect_key = None
+    inspection = None
+    if inspect_cache_path:
+        inspect_cache = InspectionCache(inspect_cache_path)
+        inspect_key = image_header_key(patch_target)
+        inspection = inspect_cache.get(inspect_key)
+    if not inspection:
+        inspection = inspect_disk_header(patch_target)
+    if inspection:
+        record_stage(disk_image, 'inspect', start_time)
+        is_bigiq = inspection[0]
+        if not is_bigiq:
+            LOG.warn('%s is not a BIGIQ image file.. skipping..', disk_image)
+    if not inspection or is_bigiq:
+        with PatchSession(disk_image, patch_target) as session:
+            if not inspection:
+                start_time = time.time()
+                inspection = validate_bigiq_device(session)
+                record_stage(disk_image, 'validate', start_time)
+                if inspect_cache:
+                    inspect_cache.put(inspect_key, inspection)
+            (is_bigiq, config_dev, usr_dev, var_dev, shared_dev) = inspection
+            if is_bigiq:
+                patch_image_session(session, injections, config_dev,
+                                    usr_dev, var_dev, shared_dev)
+    if patch_target == overlay_image:
+        flatten_overlay(overlay_image, disk_image)
+    return is_bigiq
+
+
+def patch_image_batch(disk_images, injections, inspect_cache_path=None):
+    """Inject files into several BIGIQ disk images sharing one appliance
+
+    Identical images, such as the images of one build, carry the same
+    LVM volume group name and UUIDs. LVM can only activate one of them at
+    a time, so the appliance LVM filter is narrowed to each drive in turn
+    before its volumes are looked up and patched. Returns a list of
+    (disk_image, is_bigiq) tuples.
+    """
+    results = []
+    batch_images = []
+    batch_targets = []
+    batch_inspections = []
+    for disk_image in disk_images:
+        patch_target = disk_image
+        overlay_image = "%s%s" % (disk_image, OVERLAY_EXT)
+        if os.path.exists(overlay_image):
+            patch_target = overlay_image
+        inspect_key = None
+        inspection = None
+        if inspect_cache_path:
+            inspect_key = image_header_key(patch_target)
+            inspection = InspectionCache(inspect_cache_path).get(inspect_key)
+        if not inspection:
+            inspection = inspect_disk_header(patch_target)
+        if inspection and not inspection[0]:
+            results.append((disk_image,
+                            patch_image(disk_image, injections,
+                                        inspect_cache_path)))
+            continue
+        batch_images.append(disk_image)
+        batch_targets.append(patch_target)
+        batch_inspections.append((inspect_key, inspection))
+    if not batch_images:
+        return results
+    with BatchSession(batch_images, batch_targets) as batch:
+        for index, disk_image in enumerate(batch_images):
+            (inspect_key, inspection) = batch_inspections[index]
+            with batch.session(index) as session:
+                if not inspection:
+                    start_time = time.time()
+                    inspection = validate_bigiq_device(session)
+                    record_stage(disk_image, 'validate', start_time,
+                                 drives=len(batch_images))
+                    if inspect_key:
+                        InspectionCache(inspect_cache_path).put(
+                            inspect_key, inspection)
+                if inspection[0]:
+                    patch_image_session(session, injections, *inspection[1:])
+            results.append((disk_image, inspection[0]))
+    for (disk_image, patch_target) in zip(batch_images, batch_targets):
+        if patch_target != disk_image:
+            flatten_overlay(patch_target, disk_image)
+    return results
+
+
+def list_repatch_images(extract_dir):
+    """List the patched disk images of a directory with JSON manifests"""
+    repatch_images = []
+    for file_name in sorted(os.listdir(extract_dir)):
+        file_path = os.path.join(extract_dir, file_name)
+        if os.path.splitext(file_name)[1] in REPATCH_IMAGE_TYPES and \
+                os.path.exists("%s.manifest.json" % file_path):
+            repatch_images.append(file_path)
+    return repatch_images
+
+
+def repatch_image(disk_image, injections, inspect_cache_path=None):
+    """Incrementally patch a previously patched BIGIQ disk image
+
+    The JSON manifest of the previous patch is compared with the planned
+    injections. Only added or changed files are uploaded and files no
+    longer in the injection trees are removed. Returns the disk image for
+    finalizing, or None when the disk image is already up to date.
+    """
+    with open("%s.manifest.json" % disk_image, 'r') as manifest_file:
+        previous = dict([(entry['path'], entry)
+                         for entry in json.load(manifest_file)['files']])
+    manifest = PatchManifest(disk_image)
+    changed = []
+    for injected_file in list_planned_files(injections):
+        manifest.add(injected_file['path'], injected_file['local_path'])
+        entry = previous.pop(injected_file['path'], None)
+        if entry != manifest.entries[-1]:
+            changed.append(injected_file)
+    removed = sorted(previous)
+    if not changed and not removed:
+        LOG.info('%s is up to date with the injection trees', disk_image)
+        return None
+    LOG.info('incrementally patching %s: %d changed, %d removed files',
+             disk_image, len(changed), len(removed))
+    unshare_image_files(disk_image)
+    start_report(disk_image)
+    start_time = time.time()
+    inspect_cache = None
+    inspect_key = None
+    inspection = None
+    if inspect_cache_path:
+        inspect_cache = InspectionCache(inspect_cache_path)
+        inspect_key = image_header_key(disk_image)
+        inspection = inspect_cache.get(inspect_key)
+    if not inspection:
+        inspection = inspect_disk_header(disk_image)
+    with PatchSession(disk_image) as session:
+        if not inspection:
+            inspection = validate_bigiq_device(session)
+            if inspect_cache:
+                inspect_cache.put(inspect_key, inspection)
+        if not inspection[0]:
+            raise Exception("%s is no longer a BIGIQ image" % disk_image)
+        devs = {
+            'config': inspection[1],
+            'usr': inspection[2],
+            'var': inspection[3],
+            'shared': inspection[4]
+        }
+        for injected_file in changed:
+            session.mount(devs[injected_file['file_system']])
+            remote = injected_file['path'][len(injected_file['mount_point']):]
+            LOG.debug('injecting %s to %s', injected_file['local_path'],
+                      injected_file['path'])
+            session.gfs.mkdir_p(os.path.dirname(remote))
+            session.gfs.upload(injected_file['local_path'], remote)
+            session.gfs.chmod(
+                stat.S_IMODE(os.stat(injected_file['local_path']).st_mode),
+                remote)
+        for removed_path in removed:
+            mount_point = "/%s" % removed_path.split('/')[1]
+            LOG.debug('removing %s', removed_path)
+            session.mount(devs[MOUNT_FILE_SYSTEMS[mount_point]])
+            session.gfs.rm_f(removed_path[len(mount_point):])
+        session.umount()
+        session.manifest = manifest
+        session.manifest.write()
+    record_stage(disk_image, 'repatch', start_time,
+                 sum([os.path.getsize(injected_file['local_path'])
+                      for injected_file in changed]),
+                 len(changed) + len(removed), removed=len(removed))
+    return disk_image
+
+
+def package_image(disk_image, is_bigiq):
+    """Package a patched disk image, returning the output image path"""
+    if is_bigiq and os.path.splitext(disk_image)[1] == '.vmdk':
+        start_time = time.time()
+        ova_path = clean_up_vmdk(disk_image)
+        record_stage(ova_path, 'ova_pack', start_time,
+                     os.path.getsize(ova_path), 1)
+        return ova_path
+    return disk_image
+
+
+def finalize_image(disk_image, signer, image_build_id,
+                   digest_algorithms=None):
+    """Checksum, sign and rename an output image, returning its final path
+
+    The image is signed from the SHA384 digest computed with its other
+    digests, and the .md5 and manifest files get detached signatures.
+    """
+    start_time = time.time()
+    digests = digest_image(disk_image, digest_algorithms)
+    generate_md5sum(disk_image, digests['md5'])
+    if digest_algorithms:
+        generate_digest_files(disk_image, digests, digest_algorithms)
+    record_stage(disk_image, 'digest', start_time,
+                 os.path.getsize(disk_image), 1)
+    if signer:
+        start_time = time.time()
+        try:
+            signer.sign_image(disk_image, digests['sha384'])
+            for signed_ext in ['.md5'] + MANIFEST_EXTS[0:2]:
+                if os.path.exists("%s%s" % (disk_image, signed_ext)):
+                    signer.sign_file("%s%s" % (disk_image, signed_ext))
+        except Exception as ex:
+            LOG.error("could not sign %s with private key %s: %s",
+                      disk_image, signer.private_key_path, ex)
+        record_stage(disk_image, 'sign', start_time)
+    if image_build_id and \
+            not os.path.splitext(disk_image)[0].endswith(image_build_id):
+        start_time = time.time()
+        build_split = os.path.splitext(disk_image)
+        build_name = "%s-%s%s" % (build_split[0], image_build_id, build_split[1])
+        os.rename(disk_image, build_name)
+        os.rename("%s.md5" % disk_image, "%s.md5" % build_name)
+        rename_manifests(disk_image, build_name)
+        for sig_ext in [SIGNATURE_EXT, ".md5%s" % SIGNATURE_EXT]:
+            sig_file = "%s%s" % (disk_image, sig_ext)
+            if os.path.exists(sig_file):
+                os.rename(sig_file, "%s%s" % (build_name, sig_ext))
+        if digest_algorithms:
+            for algorithm in digest_algorithms:
+                os.rename("%s.%s" % (disk_image, algorithm),
+                          "%s.%s" % (build_name, algorithm))
+        record_stage(disk_image, 'rename', start_time)
+        os.rename(report_path(disk_image), report_path(build_name))
+        return build_name
+    return disk_image
+
+
+def patch_image_session(session, injections, config_dev, usr_dev, var_dev,
+                        shared_dev):
+    """Apply all planned file injections to a BIGIQ disk image in one session"""
+    for manifest_ext in MANIFEST_EXTS:
+        manifest_file_path = "%s%s" % (session.disk_image, manifest_ext)
+        if os.path.exists(manifest_file_path):
+            LOG.info('deleting previous manifest file %s', manifest_file_path)
+            os.unlink(manifest_file_path)
+    devs = {
+        'config': config_dev,
+        'usr': usr_dev,
+        'var': var_dev,
+        'shared': shared_dev
+    }
+    for injection in injections:
+        dev = devs[injection['file_system']]
+        if not dev:
+            continue
+        if injection['stage'] == 'inject_cloudinit_config_template':
+            inject_cloudinit_config_template(session, injection['local_path'],
+                                             dev)
+        else:
+            inject_files(session, injection['local_path'], dev,
+                         injection['mount_point'], injection['remote_dir'],
+                         injection['stage'])
+    session.umount()
+    session.manifest.write()
+
+
+def scan_for_images(tmos_image_dir, image_overwrite, image_build_id,
+                    patch_cache=None):
     """Scan for BIG-IQ disk images"""
     return_image_files = []
+    (archives, _) = scan_for_archives(tmos_image_dir, image_overwrite,
+                                      image_build_id, patch_cache)
+    for archive in archives:
+        for disk_image in extract_images(*archive):
+            return_image_files.append(prepare_image(disk_image))
+    return return_image_files
+
+
+def plan_patch(tmos_image_dir, bigiq_cloudinit_dir, bigiq_usr_inject_dir,
+               bigiq_var_inject_dir, bigiq_config_inject_dir,
+               bigiq_shared_inject_dir, cloud_template_file, image_overwrite,
+               image_build_id, patch_cache=None, dry_run=False,
+               incremental=False):
+    """Plan a patching run without launching libguestfs
+
+    Disk images are named from archive member listings, so nothing is
+    extracted. Returns a dictionary holding the archives to hand to the
+    patch pipeline, the disk images they contain, the previously patched
+    disk images to update incrementally and the injections to apply to
+    each disk image with their file and byte totals.
+    """
+    (archives, skipped_dirs) = scan_for_archives(tmos_image_dir,
+                                                 image_overwrite,
+                                                 image_build_id, patch_cache,
+                                                 dry_run, incremental)
+    repatch_images = []
+    if incremental and not image_overwrite:
+        for extract_dir in sorted(skipped_dirs):
+            if image_build_id and not os.path.splitext(
+                    os.path.basename(extract_dir))[0].endswith(image_build_id):
+                LOG.warn('%s is not from build %s.. not re-patching.',
+                         extract_dir, image_build_id)
+                continue
+            repatch_images = repatch_images + list_repatch_images(extract_dir)
+    images = []
+    for (archive_file, extract_dir, archive_members) in archives:
+        if archive_members is None:
+            image_names = []
+            if os.path.isdir(extract_dir):
+                image_names = os.listdir(extract_dir)
+        else:
+            image_names = [
+                os.path.basename(member) for member in archive_members
+            ]
+        images.append({
+            'archive': archive_file,
+            'extract_dir': extract_dir,
+            'disk_images': [
+                os.path.join(extract_dir, image_name)
+                for image_name in image_names
+                if os.path.splitext(image_name)[1] in IMAGE_TYPES
+            ]
+        })
+    injections = plan_injections(bigiq_cloudinit_dir, bigiq_usr_inject_dir,
+                                 bigiq_var_inject_dir,
+                                 bigiq_config_inject_dir,
+                                 bigiq_shared_inject_dir, cloud_template_file)
+    return {
+        'archives': archives,
+        'images': images,
+        'repatch_images': repatch_images,
+        'injections': injections,
+        'files': sum([injection['files'] for injection in injections]),
+        'bytes': sum([injection['bytes'] for injection in injections])
+    }
+
+
+def plan_injections(bigiq_cloudinit_dir, bigiq_usr_inject_dir,
+                    bigiq_var_inject_dir, bigiq_config_inject_dir,
+                    bigiq_shared_inject_dir, cloud_template_file):
+    """Plan the file injections applied to every BIG-IQ disk image
+
+    Returns a list of injections in the order they are applied. Each
+    names its stage, the file system it patches, the local source tree
+    or file, the remote directory and the files and bytes injected.
+    """
+    sources = []
+    if bigiq_cloudinit_dir:
+        sources.append(
+            ('inject_cloudinit_modules', 'usr', '/usr',
+             "%s/image_patch_files/system_python_path" % bigiq_cloudinit_dir,
+             '/local/lib/python2.7'))
+    if cloud_template_file:
+        sources.append(('inject_cloudinit_config_template', 'usr', '/usr',
+                        cloud_template_file, CLOUDINIT_TEMPLATE_DIR))
+    sources = sources + [
+        ('inject_usr', 'usr', '/usr', bigiq_usr_inject_dir, '/'),
+        ('inject_var', 'var', '/var', bigiq_var_inject_dir, '/'),
+        ('inject_shared', 'shared', '/shared', bigiq_shared_inject_dir, '/'),
+        ('inject_config', 'config', '/config', bigiq_config_inject_dir, '/')
+    ]
+    injections = []
+    for (stage, file_system, mount_point, local_path, remote_dir) in sources:
+        if not local_path:
+            continue
+        if os.path.isfile(local_path):
+            local_files = [local_path]
+        else:
+            local_files = [
+                "%s%s" % (local_path, inject_file)
+                for inject_file in list_inject_files(local_path)
+            ]
+        injections.append({
+            'stage': stage,
+            'file_system': file_system,
+            'mount_point': mount_point,
+            'local_path': local_path,
+            'remote_dir': remote_dir,
+            'files': len(local_files),
+            'bytes': sum([os.path.getsize(path) for path in local_files])
+        })
+    return injections
+
+
+def list_planned_files(injections):
+    """List every file of the planned injections
+
+    Each file names its manifest path, the file system and mount point
+    it is injected into and its local source file.
+    """
+    planned_files = []
+    for injection in injections:
+        if injection['stage'] == 'inject_cloudinit_config_template':
+            planned_files.append({
+                'path': "%s%s/cloud-init.tmpl" % (injection['mount_point'],
+                                                  CLOUDINIT_TEMPLATE_DIR),
+                'file_system': injection['file_system'],
+                'mount_point': injection['mount_point'],
+                'local_path': injection['local_path']
+            })
+            continue
+        for inject_file in list_inject_files(injection['local_path']):
+            planned_files.append({
+                'path': "%s%s%s" % (injection['mount_point'],
+                                    injection['remote_dir'].rstrip('/'),
+                                    inject_file),
+                'file_system': injection['file_system'],
+                'mount_point': injection['mount_point'],
+                'local_path': "%s%s" % (injection['local_path'], inject_file)
+            })
+    return planned_files
+
+
+def write_plan(tmos_image_dir, plan):
+    """Log a patch plan and write it as JSON to the image directory"""
+    for image in plan['images']:
+        for disk_image in image['disk_images']:
+            LOG.info('plan: patch %s from %s', disk_image, image['archive'])
+    for disk_image in plan['repatch_images']:
+        LOG.info('plan: incrementally patch %s', disk_image)
+    for injection in plan['injections']:
+        LOG.info('plan: %s injects %d files (%d bytes) into %s%s',
+                 injection['stage'], injection['files'], injection['bytes'],
+                 injection['mount_point'], injection['remote_dir'].rstrip('/'))
+    LOG.info('plan: %d images, %d files (%d bytes) per image',
+             sum([len(image['disk_images']) for image in plan['images']]),
+             plan['files'], plan['bytes'])
+    plan_path = os.path.join(tmos_image_dir, PLAN_FILE)
+    write_atomic(plan_path, json.dumps({
+        'images': plan['images'],
+        'repatch_images': plan['repatch_images'],
+        'injections': plan['injections'],
+        'files': plan['files'],
+        'bytes': plan['bytes']
+    }, indent=2))
+    LOG.info('wrote patch plan %s', plan_path)
+
+
+def scan_for_archives(tmos_image_dir, image_overwrite, image_build_id,
+                      patch_cache=None, dry_run=False, incremental=False):
+    """Scan for BIG-IQ disk image archives which need patching
+
+    Returns a list of (archive_file, extract_dir, archive_members) tuples
+    for every archive not skipped as already patched or restored from
+    the patch cache, and the list of patch directories skipped as
+    already patched for the current build id. With dry_run set no patch
+    directory is created, unlinked or restored. With incremental set,
+    patch directories holding images which can be patched incrementally
+    are always skipped.
+    """
+    return_archives = []
+    skipped_dirs = []
     for image_file in os.listdir(tmos_image_dir):
         filepath = "%s/%s" % (tmos_image_dir, image_file)
+        if image_file in [RUN_REPORT_FILE, PLAN_FILE] or \
+                image_file.startswith('.'):
+            continue
         if os.path.isfile(filepath):
             extract_dir = "%s/%s" % (tmos_image_dir,
                                      os.path.splitext(image_file)[0])
@@ -133,6 +954,20 @@ def scan_for_images(tmos_image_dir, image_overwrite, image_build_id):
                                                   build_split[0],
                                                   image_build_id,
                                                   build_split[1])
+            arch_ext = os.path.splitext(image_file)[1]
+            archive_members = None
+            if arch_ext in ARCHIVE_EXTS:
+                archive_members = list_archive_members(filepath)
+                if not [
+                        member for member in archive_members
+                        if os.path.splitext(member)[1] in IMAGE_TYPES
+                ]:
+                    LOG.warn('%s contains no disk image.. skipping..',
+                             filepath)
+                    continue
+            cache_key = None
+            if patch_cache and arch_ext in ARCHIVE_EXTS:
+                cache_key = patch_cache.key(filepath, extract_dir)
             if os.path.exists(extract_dir):
                 found_sum_files = False
                 LOG.debug('examining existing patching directory %s' %
@@ -143,72 +978,683 @@ def scan_for_images(tmos_image_dir, image_overwrite, image_build_id):
                                   existing_file)
                         found_sum_files = True
                 if not image_overwrite and found_sum_files:
-                    LOG.info(
-                        'previous patch artifacts found in %s.. skipping patching.'
-                        % extract_dir)
-                    continue
-            else:
+                    if not cache_key or patch_cache.is_current(extract_dir) \
+                            or (incremental and
+                                list_repatch_images(extract_dir)):
+                        LOG.info(
+                            'previous patch artifacts found in %s.. skipping patching.'
+                            % extract_dir)
+                        skipped_dirs.append(extract_dir)
+                        continue
+                    LOG.info('patch inputs changed for %s.. re-patching.' %
+                             extract_dir)
+                if not dry_run:
+                    clear_patch_dir(extract_dir)
+            elif not dry_run:
                 LOG.debug('creating patching directory %s' % extract_dir)
                 os.makedirs(extract_dir)
-            arch_ext = os.path.splitext(image_file)[1]
-            if arch_ext in ARCHIVE_EXTS:
-                if ARCHIVE_EXTS[arch_ext] == 'zipfile':
-                    extract_zip_archive(filepath, extract_dir)
-                if ARCHIVE_EXTS[arch_ext] == 'tarfile':
-                    extract_tar_archive(filepath, extract_dir)
-            for extracted_file in os.listdir(extract_dir):
-                if os.path.splitext(extracted_file)[1] in IMAGE_TYPES:
-                    image_filepath = "%s/%s" % (extract_dir, extracted_file)
-                    if os.path.splitext(extracted_file)[1] == '.vmdk':
-                        convert_vmdk(image_filepath,
-                                     VBOXMANAGE_CLI_PATCH_VARIANT)
-                    return_image_files.append(image_filepath)
-    return return_image_files
+            if cache_key and not image_overwrite and \
+                    patch_cache.has_entry(extract_dir):
+                if not dry_run:
+                    patch_cache.restore(extract_dir)
+                continue
+            return_archives.append((filepath, extract_dir, archive_members))
+    return (return_archives, skipped_dirs)
+
+
+def extract_images(archive_file, extract_dir, archive_members):
+    """Extract BIG-IQ disk images into a patch directory
+
+    Returns the disk image paths found in the patch directory.
+    """
+    start_time = time.time()
+    byte_count = 0
+    arch_ext = os.path.splitext(archive_file)[1]
+    if arch_ext in ARCHIVE_EXTS:
+        if OVERLAY_MODE:
+            disk_images = create_overlays(archive_file, extract_dir,
+                                          archive_members)
+            for disk_image in disk_images:
+                start_report(disk_image)
+                record_stage(disk_image, 'overlay', start_time)
+            return disk_images
+        if ARCHIVE_EXTS[arch_ext] == 'zipfile':
+            byte_count = extract_zip_archive(archive_file, extract_dir,
+                                             archive_members)
+        if ARCHIVE_EXTS[arch_ext] == 'tarfile':
+            byte_count = extract_tar_archive(archive_file, extract_dir,
+                                             archive_members)
+    disk_images = []
+    for extracted_file in os.listdir(extract_dir):
+        if os.path.splitext(extracted_file)[1] in IMAGE_TYPES:
+            disk_images.append(os.path.join(extract_dir, extracted_file))
+    for disk_image in disk_images:
+        start_report(disk_image)
+        record_stage(disk_image, 'extract', start_time, byte_count,
+                     len(archive_members or []))
+    return disk_images
+
+
+def prepare_image(disk_image):
+    """Convert extracted VMDK disk images to the patchable variant"""
+    if os.path.splitext(disk_image)[1] == '.vmdk' and \
+            not os.path.exists("%s%s" % (disk_image, OVERLAY_EXT)):
+        start_time = time.time()
+        convert_vmdk(disk_image, VBOXMANAGE_CLI_PATCH_VARIANT)
+        record_stage(disk_image, 'convert', start_time,
+                     os.path.getsize(disk_image), 1)
+    return disk_image
+
+
+def create_overlays(archive_file, extract_dir, members):
+    """Create qcow2 overlays backed by pristine extracted disk images
+
+    Pristine images are extracted once into a base directory shared by
+    every build of the same archive. Each disk image gets a qcow2
+    overlay in the patch directory which is flattened into the output
+    image once patching completes. Returns the output disk image paths.
+    """
+    base_dir = os.path.join(os.path.dirname(archive_file), OVERLAY_BASE_DIR,
+                            os.path.basename(archive_file))
+    if not [
+            member for member in members if not os.path.exists(
+                os.path.join(base_dir, os.path.basename(member)))
+    ]:
+        LOG.info('reusing pristine images for %s in %s', archive_file,
+                 base_dir)
+    else:
+        base_tmp_dir = "%s.tmp" % base_dir
+        if os.path.exists(base_tmp_dir):
+            shutil.rmtree(base_tmp_dir)
+        os.makedirs(base_tmp_dir)
+        if ARCHIVE_EXTS[os.path.splitext(archive_file)[1]] == 'zipfile':
+            extract_zip_archive(archive_file, base_tmp_dir, members)
+        else:
+            extract_tar_archive(archive_file, base_tmp_dir, members)
+        if os.path.exists(base_dir):
+            shutil.rmtree(base_dir)
+        os.rename(base_tmp_dir, base_dir)
+    disk_images = []
+    for member in members:
+        member_name = os.path.basename(member)
+        base_image = os.path.join(base_dir, member_name)
+        member_ext = os.path.splitext(member_name)[1]
+        if member_ext not in IMAGE_TYPES:
+            shutil.copy(base_image, os.path.join(extract_dir, member_name))
+            continue
+        disk_image = os.path.join(extract_dir, member_name)
+        overlay_image = "%s%s" % (disk_image, OVERLAY_EXT)
+        if os.path.exists(overlay_image):
+            os.unlink(overlay_image)
+        LOG.info('creating qcow2 overlay %s backed by %s', overlay_image,
+                 base_image)
+        subprocess.check_call([
+            QEMU_IMG_CLI, 'create', '-q', '-f', 'qcow2', '-F',
+            QEMU_IMG_FORMATS[member_ext], '-b',
+            os.path.abspath(base_image), overlay_image
+        ])
+        disk_images.append(disk_image)
+    return disk_images
+
+
+def flatten_overlay(overlay_image, disk_image):
+    """Flatten a qcow2 overlay and its backing image into the output format"""
+    image_ext = os.path.splitext(disk_image)[1]
+    output_format = QEMU_IMG_FORMATS[image_ext]
+    convert_cmd = [QEMU_IMG_CLI, 'convert', '-O', output_format]
+    if image_ext == '.vhd':
+        base_image = json.loads(
+            subprocess.check_output([
+                QEMU_IMG_CLI, 'info', '--output=json', '--backing-chain',
+                overlay_image
+            ]).decode('utf8'))[-1]['filename']
+        # keep the exact virtual size instead of a CHS rounded one, as
+        # cloud platforms require 1 MiB aligned VHDs
+        subformat = 'dynamic'
+        if vhd_disk_type(base_image) == VHD_FIXED_DISK:
+            subformat = 'fixed'
+        convert_cmd.extend(
+            ['-o', "subformat=%s,force_size=on" % subformat])
+    flattened_image = "%s.flattened" % disk_image
+    start_time = time.time()
+    LOG.info('flattening overlay %s to %s format image %s', overlay_image,
+             output_format, disk_image)
+    subprocess.check_call(convert_cmd + [overlay_image, flattened_image])
+    os.rename(flattened_image, disk_image)
+    os.unlink(overlay_image)
+    record_stage(disk_image, 'flatten', start_time,
+                 os.path.getsize(disk_image), 1)
+
+
+def file_digest(file_path, algorithm='sha256'):
+    """Return the hex digest of a file read in large sequential blocks"""
+    file_hash = hashlib.new(algorithm)
+    with open(file_path, 'rb') as fp:
+        for block in iter(lambda: fp.read(DIGEST_BLOCK_SIZE), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def digest_inject_tree(tree_hash, local_dir):
+    """Update a hash with the relative paths, modes and content of a tree"""
+    for inject_file in sorted(list_inject_files(local_dir)):
+        local = "%s%s" % (local_dir, inject_file)
+        tree_hash.update(inject_file.encode('utf8'))
+        tree_hash.update(
+            ("%o" % stat.S_IMODE(os.lstat(local).st_mode)).encode('utf8'))
+        tree_hash.update(file_digest(local).encode('utf8'))
+
+
+def clone_file(source_file, dest_file):
+    """Copy a file sharing data blocks where the file system allows it
+
+    A reflink copy is attempted first, then a hard link and finally a
+    full copy.
+    """
+    if os.path.lexists(dest_file):
+        os.unlink(dest_file)
+    fnull = open(os.devnull, 'w')
+    if subprocess.call(['/bin/cp', '--reflink=always', source_file, dest_file],
+                       stdout=fnull, stderr=subprocess.STDOUT) == 0:
+        return
+    try:
+        os.link(source_file, dest_file)
+    except OSError:
+        shutil.copy2(source_file, dest_file)
+
+
+def unshare_image_files(disk_image):
+    """Break hard links between a disk image's artifacts and the cache
+
+    Images restored from the patch cache may share their inode with the
+    cache entry. Each such file is replaced by a private copy, reflinked
+    where the file system allows it, before it is rewritten in place.
+    """
+    image_dir = os.path.dirname(disk_image)
+    for file_name in os.listdir(image_dir):
+        file_path = os.path.join(image_dir, file_name)
+        if not file_name.startswith(os.path.basename(disk_image)) or \
+                not os.path.isfile(file_path) or \
+                os.stat(file_path).st_nlink < 2:
+            continue
+        LOG.debug('breaking hard link of %s before re-patching', file_path)
+        unshared_path = "%s.unshared" % file_path
+        subprocess.check_call([
+            '/bin/cp', '--reflink=auto', '--preserve=mode,timestamps',
+            file_path, unshared_path
+        ])
+        os.rename(unshared_path, file_path)
+
+
+def clear_patch_dir(extract_dir):
+    """Remove the artifacts of a previous run before re-patching
+
+    Everything but the recorded cache key is removed, so renamed output
+    images and files shared with the patch cache are never mistaken for
+    freshly extracted disk images or rewritten in place.
+    """
+    LOG.debug('clearing previous patch artifacts from %s', extract_dir)
+    for file_name in os.listdir(extract_dir):
+        if file_name == PATCH_CACHE_KEY_FILE:
+            continue
+        file_path = os.path.join(extract_dir, file_name)
+        if os.path.isdir(file_path) and not os.path.islink(file_path):
+            shutil.rmtree(file_path)
+        else:
+            os.unlink(file_path)
+
+
+class PatchCache(object):
+    """Content addressed cache of patched image artifacts
+
+    Entries are keyed by the digest of the source archive, the injection
+    trees, the cloudinit template, the image build id and the settings
+    which change the artifacts, such as the signing key fingerprint and
+    the image digests generated. Archive
+    digests are memoized by path, size and modification time so an
+    unchanged archive is only read once.
+    """
+
+    def __init__(self, cache_dir, inject_dirs, template_file, image_build_id,
+                 settings=None):
+        self.cache_dir = cache_dir
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self.archive_index_path = os.path.join(cache_dir,
+                                               PATCH_CACHE_ARCHIVE_INDEX)
+        self.archive_index = {}
+        if os.path.exists(self.archive_index_path):
+            with open(self.archive_index_path, 'r') as index_file:
+                self.archive_index = json.load(index_file)
+        self.keys = {}
+        input_hash = hashlib.sha256()
+        for inject_dir in inject_dirs:
+            input_hash.update(b'\0')
+            if inject_dir and os.path.isdir(inject_dir):
+                digest_inject_tree(input_hash, inject_dir)
+        input_hash.update(b'\0')
+        if template_file and os.path.isfile(template_file):
+            input_hash.update(file_digest(template_file).encode('utf8'))
+        input_hash.update(b'\0')
+        if image_build_id:
+            input_hash.update(image_build_id.encode('utf8'))
+        input_hash.update(b'\0')
+        input_hash.update(
+            json.dumps(settings or {}, sort_keys=True).encode('utf8'))
+        self.input_digest = input_hash.hexdigest()
+        LOG.debug('patch input digest is %s', self.input_digest)
+
+    def archive_digest(self, archive_file):
+        """Return the memoized SHA256 digest of a source archive"""
+        archive_stat = os.stat(archive_file)
+        entry = self.archive_index.get(archive_file)
+        if entry and entry['size'] == archive_stat.st_size and \
+                entry['mtime'] == archive_stat.st_mtime:
+            return entry['sha256']
+        LOG.info('calculating sha256 digest for archive %s', archive_file)
+        digest = file_digest(archive_file)
+        self.archive_index[archive_file] = {
+            'size': archive_stat.st_size,
+            'mtime': archive_stat.st_mtime,
+            'sha256': digest
+        }
+        index_tmp_path = "%s.tmp" % self.archive_index_path
+        with open(index_tmp_path, 'w') as index_file:
+            json.dump(self.archive_index, index_file, indent=2)
+        os.rename(index_tmp_path, self.archive_index_path)
+        return digest
+
+    def key(self, archive_file, extract_dir):
+        """Return and record the cache key for an archive patch directory"""
+        cache_key = hashlib.sha256(
+            ("%s:%s" % (self.archive_digest(archive_file),
+                        self.input_digest)).encode('utf8')).hexdigest()
+        self.keys[extract_dir] = cache_key
+        return cache_key
+
+    def is_current(self, extract_dir):
+        """Test if a patch directory was produced from the current inputs"""
+        key_file_path = os.path.join(extract_dir, PATCH_CACHE_KEY_FILE)
+        if not os.path.exists(key_file_path):
+            return False
+        with open(key_file_path, 'r') as key_file:
+            return key_file.read().strip() == self.keys.get(extract_dir)
+
+    def has_entry(self, extract_dir):
+        """Test if the cache holds artifacts for a patch directory"""
+        cache_key = self.keys.get(extract_dir)
+        return bool(cache_key) and os.path.isdir(
+            os.path.join(self.cache_dir, cache_key))
+
+    def restore(self, extract_dir):
+        """Restore previously patched artifacts into a patch directory"""
+        if not self.has_entry(extract_dir):
+            return False
+        cache_key = self.keys.get(extract_dir)
+        entry_dir = os.path.join(self.cache_dir, cache_key)
+        LOG.info('restoring patched artifacts for %s from cache entry %s',
+                 extract_dir, cache_key)
+        for file_name in os.listdir(entry_dir):
+            clone_file(os.path.join(entry_dir, file_name),
+                       os.path.join(extract_dir, file_name))
+        self.write_key(extract_dir)
+        return True
+
+    def store(self, extract_dir):
+        """Store the artifacts of a patch directory in the cache"""
+        cache_key = self.keys.get(extract_dir)
+        if not cache_key:
+            return
+        entry_dir = os.path.join(self.cache_dir, cache_key)
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir)
+        entry_tmp_dir = "%s.tmp" % entry_dir
+        if os.path.isdir(entry_tmp_dir):
+            shutil.rmtree(entry_tmp_dir)
+        os.makedirs(entry_tmp_dir)
+        LOG.info('storing patched artifacts for %s in cache entry %s',
+                 extract_dir, cache_key)
+        for file_name in os.listdir(extract_dir):
+            file_path = os.path.join(extract_dir, file_name)
+            if os.path.isfile(file_path) and \
+                    file_name != PATCH_CACHE_KEY_FILE:
+                clone_file(file_path, os.path.join(entry_tmp_dir, file_name))
+        os.rename(entry_tmp_dir, entry_dir)
+        self.write_key(extract_dir)
+
+    def store_results(self, results):
+        """Store every patch directory whose images all patched successfully"""
+        extract_dirs = {}
+        for (disk_image, success, error) in results:
+            extract_dir = os.path.dirname(disk_image)
+            extract_dirs[extract_dir] = extract_dirs.get(extract_dir,
+                                                         True) and success
+        for extract_dir in extract_dirs:
+            if extract_dirs[extract_dir]:
+                self.store(extract_dir)
+
+    def write_key(self, extract_dir):
+        """Record the cache key a patch directory was produced from"""
+        with open(os.path.join(extract_dir, PATCH_CACHE_KEY_FILE),
+                  'w') as key_file:
+            key_file.write(self.keys[extract_dir])
+
+
+def list_archive_members(archive_file):
+    """List the disk image and OVF members of a zip or tar archive"""
+    arch_ext = os.path.splitext(archive_file)[1]
+    member_names = []
+    if ARCHIVE_EXTS[arch_ext] == 'zipfile':
+        with zipfile.ZipFile(archive_file, 'r') as archive:
+            member_names = [
+                info.filename for info in archive.infolist()
+                if not info.filename.endswith('/')
+            ]
+    if ARCHIVE_EXTS[arch_ext] == 'tarfile':
+        with tarfile.open(archive_file, 'r') as archive:
+            member_names = [
+                member.name for member in archive.getmembers()
+                if member.isreg()
+            ]
+    return [
+        member_name for member_name in member_names
+        if os.path.splitext(member_name)[1] in EXTRACT_MEMBER_TYPES
+    ]
+
+
+def extract_member(member_file, member_name, extract_dir, progress=None):
+    """Stream an archive member into the extract directory"""
+    extract_path = os.path.join(extract_dir, os.path.basename(member_name))
+    with open(extract_path, 'wb') as extract_file:
+        for block in iter(lambda: member_file.read(EXTRACT_BLOCK_SIZE), b''):
+            extract_file.write(block)
+            if progress:
+                progress.update(len(block))
+    return os.path.getsize(extract_path)
+
+
+class Progress(object):
+    """Bounded rate progress reporting for long running file I/O
+
+    Bytes done, throughput, ETA and CPU use are logged at most every
+    PROGRESS_LOG_INTERVAL seconds and, when PROGRESS_JSON_FILE is set,
+    appended to it as JSON lines. CPU use is that of an attached child
+    process, such as a converter, or else of this process. CPU use near
+    100% points at CPU bound work, low CPU use at waiting on the disk.
+    """
+
+    json_lock = threading.Lock()
+
+    def __init__(self, action, file_path, total_bytes=None):
+        self.action = action
+        self.file_path = file_path
+        self.total_bytes = total_bytes
+        self.byte_count = 0
+        self.pid = None
+        self.lock = threading.Lock()
+        self.watcher = None
+        self.watch_stop = threading.Event()
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        self.start_cpu = self.cpu_seconds()
+        self.last_cpu = self.start_cpu
+
+    def attach(self, pid):
+        """Report the CPU use of a child process doing the work"""
+        self.pid = pid
+        self.start_cpu = self.cpu_seconds()
+        self.last_cpu = self.start_cpu
+
+    def cpu_seconds(self):
+        """Return the CPU seconds used by the attached or this process"""
+        if not self.pid:
+            return time.process_time()
+        try:
+            with open("/proc/%d/stat" % self.pid, 'r') as stat_file:
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / float(
+                os.sysconf('SC_CLK_TCK'))
+        except (IOError, OSError, IndexError, ValueError):
+            return None
+
+    def update(self, byte_count):
+        """Add bytes done, reporting if the log interval has passed"""
+        with self.lock:
+            self.byte_count += byte_count
+            if time.time() - self.last_report >= PROGRESS_LOG_INTERVAL:
+                self.report()
+
+    def set(self, byte_count):
+        """Set bytes done, reporting if the log interval has passed"""
+        with self.lock:
+            self.byte_count = byte_count
+            if time.time() - self.last_report >= PROGRESS_LOG_INTERVAL:
+                self.report()
 
+    def watch(self, file_path):
+        """Take bytes done from the size of a growing output file"""
 
-def extract_tar_archive(archive_file, extract_dir):
-    """Extract a tar archive"""
-    LOG.debug('extracting %s to %s', archive_file, extract_dir)
-    archive = tarfile.TarFile(archive_file, 'r')
-    archive.extractall(extract_dir)
-    archive.close()
+        def watch_file():
+            while not self.watch_stop.wait(PROGRESS_WATCH_INTERVAL):
+                if os.path.exists(file_path):
+                    self.set(os.path.getsize(file_path))
 
+        self.watcher = threading.Thread(target=watch_file)
+        self.watcher.daemon = True
+        self.watcher.start()
 
-def extract_zip_archive(archive_file, extract_dir):
-    """Extract a zip archive"""
-    LOG.debug('extracting %s to %s', archive_file, extract_dir)
-    archive = zipfile.ZipFile(archive_file, 'r')
-    archive.extractall(extract_dir)
-    archive.close()
+    def finish(self):
+        """Stop watching and report the completed operation"""
+        if self.watcher:
+            self.watch_stop.set()
+            self.watcher.join()
+        with self.lock:
+            self.report(True)
 
+    def report(self, done=False):
+        """Log and record the progress of the operation"""
+        now = time.time()
+        duration = max(now - self.start_time, 0.001)
+        rate = self.byte_count / duration
+        (since_time, since_cpu) = (self.start_time, self.start_cpu) if done \
+            else (self.last_report, self.last_cpu)
+        cpu_seconds = self.cpu_seconds()
+        cpu_percent = None
+        if cpu_seconds is not None and since_cpu is not None:
+            cpu_percent = 100 * (cpu_seconds - since_cpu) / max(
+                now - since_time, 0.001)
+        self.last_report = now
+        self.last_cpu = cpu_seconds
+        eta = None
+        if not done and self.total_bytes and rate:
+            eta = max(self.total_bytes - self.byte_count, 0) / rate
+        cpu_text = 'n/a' if cpu_percent is None else "%.0f%%" % cpu_percent
+        if done:
+            LOG.info('%s %s done: %d bytes in %.1f seconds (%.1f MB/s, cpu %s)',
+                     self.action, self.file_path, self.byte_count, duration,
+                     rate / 1048576, cpu_text)
+        elif self.total_bytes:
+            LOG.info('%s %s: %d of %d MB (%.1f%%) at %.1f MB/s, '
+                     'ETA %.0f seconds, cpu %s', self.action, self.file_path,
+                     self.byte_count / 1048576, self.total_bytes / 1048576,
+                     100.0 * self.byte_count / self.total_bytes,
+                     rate / 1048576, eta or 0, cpu_text)
+        else:
+            LOG.info('%s %s: %d MB at %.1f MB/s, cpu %s', self.action,
+                     self.file_path, self.byte_count / 1048576,
+                     rate / 1048576, cpu_text)
+        if PROGRESS_JSON_FILE:
+            progress_line = json.dumps({
+                'time': round(now, 3),
+                'action': self.action,
+                'file': self.file_path,
+                'bytes': self.byte_count,
+                'total_bytes': self.total_bytes,
+                'seconds': round(duration, 3),
+                'mb_per_second': round(rate / 1048576, 3),
+                'eta_seconds': None if eta is None else round(eta, 1),
+                'cpu_percent': None
+                if cpu_percent is None else round(cpu_percent, 1),
+                'done': done
+            })
+            with Progress.json_lock:
+                with open(PROGRESS_JSON_FILE, 'a') as progress_file:
+                    progress_file.write("%s\n" % progress_line)
 
-def convert_vmdk(image_file, variant):
+
+def extract_tar_archive(archive_file, extract_dir, members=None):
+    """Extract disk image and OVF members from a tar archive"""
+    if members is None:
+        members = list_archive_members(archive_file)
+    LOG.debug('extracting %s from %s to %s', ', '.join(members),
+              archive_file, extract_dir)
+    byte_count = 0
+    with tarfile.open(archive_file, 'r') as archive:
+        progress = Progress(
+            'extracting', archive_file,
+            sum([archive.getmember(name).size for name in members]))
+        for member_name in members:
+            member_file = archive.extractfile(member_name)
+            byte_count += extract_member(member_file, member_name,
+                                         extract_dir, progress)
+            member_file.close()
+    progress.finish()
+    return byte_count
+
+
+def extract_zip_archive(archive_file, extract_dir, members=None):
+    """Extract disk image and OVF members from a zip archive"""
+    if members is None:
+        members = list_archive_members(archive_file)
+    LOG.debug('extracting %s from %s to %s', ', '.join(members),
+              archive_file, extract_dir)
+    byte_count = 0
+    with zipfile.ZipFile(archive_file, 'r') as archive:
+        progress = Progress(
+            'extracting', archive_file,
+            sum([archive.getinfo(name).file_size for name in members]))
+        for member_name in members:
+            with archive.open(member_name, 'r') as member_file:
+                byte_count += extract_member(member_file, member_name,
+                                             extract_dir, progress)
+    progress.finish()
+    return byte_count
+
+
+class VBoxManageConverter(object):
+    """VMDK conversion backend using VirtualBox vboxmanage clonemedium"""
+
+    name = 'vboxmanage'
+
+    def convert(self, image_file, converted_file, variant, progress=None):
+        """Convert a VMDK image to the requested variant
+
+        vboxmanage reports no usable progress, so progress is taken from
+        the size of the converted file as it is written.
+        """
+        FNULL = open(os.devnull, 'w')
+        convert_proc = subprocess.Popen([
+            VBOXMANAGE_CLI,
+            'clonemedium',
+            '--format',
+            VBOXMANAGE_CLI_FORMAT,
+            '--variant',
+            variant,
+            os.path.abspath(image_file),
+            os.path.abspath(converted_file),
+        ],
+                                        stdout=FNULL,
+                                        stderr=subprocess.STDOUT)
+        if progress:
+            progress.attach(convert_proc.pid)
+            progress.watch(converted_file)
+        convert_proc.wait()
+
+
+class QemuImgConverter(object):
+    """VMDK conversion backend using qemu-img convert
+
+    Conversions run with parallel coroutines, keep unallocated space
+    sparse and report the qemu-img progress.
+    """
+
+    name = 'qemu-img'
+
+    def __init__(self, coroutines=None):
+        self.coroutines = coroutines or QEMU_IMG_COROUTINES
+
+    def convert(self, image_file, converted_file, variant, progress=None):
+        """Convert a VMDK image to the requested variant"""
+        convert_cmd = [
+            QEMU_IMG_CLI, 'convert', '-p', '-m',
+            str(self.coroutines), '-S', '4k', '-O', 'vmdk', '-o',
+            "subformat=%s" % QEMU_IMG_VMDK_SUBFORMATS[variant], image_file,
+            converted_file
+        ]
+        LOG.debug('running %s', ' '.join(convert_cmd))
+        convert_proc = subprocess.Popen(convert_cmd,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.STDOUT)
+        if progress:
+            progress.attach(convert_proc.pid)
+        # qemu-img -p rewrites one short record per update, ending each
+        # with a carriage return, so read whatever the pipe holds
+        output = b''
+        record = b''
+        stdout_fd = convert_proc.stdout.fileno()
+        for chunk in iter(lambda: os.read(stdout_fd, 4096), b''):
+            output = (output + chunk)[-256:]
+            records = (record + chunk).replace(b'\n', b'\r').split(b'\r')
+            record = records.pop()
+            percents = re.findall(r'\((\d+\.\d+)/100%\)', b'\r'.join(
+                records).decode('utf8', 'ignore'))
+            if progress and percents and progress.total_bytes:
+                progress.set(
+                    int(float(percents[-1]) / 100 * progress.total_bytes))
+        convert_proc.stdout.close()
+        if convert_proc.wait() != 0:
+            raise Exception("qemu-img convert of %s failed: %s" %
+                            (image_file, output.decode('utf8', 'ignore')))
+
+
+VMDK_CONVERTERS = {
+    VBoxManageConverter.name: VBoxManageConverter,
+    QemuImgConverter.name: QemuImgConverter
+}
+
+
+def get_vmdk_converter(name=None):
+    """Return an instance of the named or configured VMDK converter"""
+    return VMDK_CONVERTERS[name or VMDK_CONVERTER]()
+
+
+def convert_vmdk(image_file, variant, converter=None):
     """Force convert VMDK image files to standard format"""
-    start_directory = os.getcwd()
-    convert_dir = os.path.dirname(image_file)
-    image_file = os.path.basename(image_file)
-    LOG.warn('converting VMDK format to %s format', variant)
-    os.chdir(convert_dir)
-    FNULL = open(os.devnull, 'w')
-    subprocess.call([
-        VBOXMANAGE_CLI,
-        'clonemedium',
-        '--format',
-        VBOXMANAGE_CLI_FORMAT,
-        '--variant',
-        variant,
-        image_file,
-        'converted.vmdk',
-    ],
-                    stdout=FNULL,
-                    stderr=subprocess.STDOUT)
-    subprocess.call(['/bin/mv', '-f', 'converted.vmdk', image_file])
-    os.chdir(start_directory)
+    if not converter:
+        converter = get_vmdk_converter()
+    converted_file = os.path.join(
+        os.path.dirname(image_file),
+        "converted-%s" % os.path.basename(image_file))
+    LOG.warn('converting VMDK %s to %s format with %s', image_file, variant,
+             converter.name)
+    progress = Progress("converting to %s" % variant, image_file,
+                        os.path.getsize(image_file))
+    try:
+        converter.convert(image_file, converted_file, variant, progress)
+    finally:
+        progress.finish()
+    os.rename(converted_file, image_file)
 
 
 def clean_up_vmdk(disk_image):
-    """Convert VMDK image to output format and remove OVF references to old image"""
+    """Convert VMDK image to output format and remove OVF references to old image
+
+    Returns the path of the OVA image packaging the converted VMDK.
+    """
+    start_time = time.time()
     convert_vmdk(disk_image, VBOXMANAGE_CLI_OUTPUT_VARIANT)
+    record_stage(disk_image, 'convert_stream', start_time,
+                 os.path.getsize(disk_image), 1)
     convert_dir = os.path.dirname(disk_image)
     for file_name in os.listdir(convert_dir):
         if file_name.endswith('.mf'):
@@ -224,17 +1670,138 @@ def clean_up_vmdk(disk_image):
             LOG.warn('patching OVF to remove restrictions')
             ovf_file_name = file_name
             clean_ovf(os.path.join(convert_dir, file_name))
-    ova_name = "%s.ova" % os.path.basename(convert_dir)
-    LOG.info('createing OVA image %s', ova_name)
-    start_directory = os.getcwd()
-    os.chdir(convert_dir)
-    ova_file = tarfile.TarFile(ova_name, 'w')
-    ova_file.add(ovf_file_name)
-    ova_file.add(os.path.basename(disk_image))
-    ova_file.close()
-    os.remove(ovf_file_name)
-    os.remove(os.path.basename(disk_image))
-    os.chdir(start_directory)
+    ova_path = os.path.join(convert_dir,
+                            "%s.ova" % os.path.basename(convert_dir))
+    LOG.info('createing OVA image %s', ova_path)
+    write_ova(ova_path, os.path.join(convert_dir, ovf_file_name), disk_image)
+    os.remove(os.path.join(convert_dir, ovf_file_name))
+    rename_manifests(disk_image, ova_path)
+    if os.path.exists(report_path(disk_image)):
+        os.rename(report_path(disk_image), report_path(ova_path))
+    return ova_path
+
+
+def ova_member_header(member_name, member_size):
+    """Return the tar header block for an OVA member"""
+    member = tarfile.TarInfo(member_name)
+    member.size = member_size
+    member.mode = 0o644
+    member.mtime = int(time.time())
+    return member.tobuf(format=tarfile.USTAR_FORMAT)
+
+
+def ova_member_padding(member_size):
+    """Return the NUL padding which ends a tar member on a block boundary"""
+    return b'\0' * (-member_size % tarfile.BLOCKSIZE)
+
+
+def insert_file_range(file_path, length):
+    """Insert length bytes of space at the start of a file in place
+
+    Uses fallocate FALLOC_FL_INSERT_RANGE so no file data is rewritten.
+    Returns False when the file system does not support it.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.fallocate.argtypes = [
+            ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64
+        ]
+        fd = os.open(file_path, os.O_RDWR)
+        try:
+            return libc.fallocate(fd, FALLOC_FL_INSERT_RANGE, 0, length) == 0
+        finally:
+            os.close(fd)
+    except Exception as ex:
+        LOG.debug('could not insert file range into %s: %s', file_path, ex)
+        return False
+
+
+def ova_manifest(members):
+    """Return the .mf manifest listing (member name, hex digest) pairs"""
+    return ''.join([
+        "%s(%s)= %s\n" % (OVA_MANIFEST_DIGEST.upper(), name, digest)
+        for (name, digest) in members
+    ]).encode('utf8')
+
+
+def write_ova(ova_path, ovf_path, disk_path):
+    """Package an OVF descriptor and a disk image as an OVA
+
+    Members are written in the order the OVF specification requires:
+    the OVF descriptor, the .mf manifest and then the disk. The tar
+    headers, OVF descriptor and manifest which precede the disk are
+    computed up front, with the disk digest left as a placeholder of
+    the same length. The OVF is padded with trailing whitespace so that
+    prefix is a whole number of file system blocks, which lets it be
+    inserted in front of the disk data in place. Where the file system
+    cannot insert ranges the disk is streamed into the OVA in a single
+    copy. The disk image is consumed either way. Once the disk is
+    written its digest is filled into the manifest slot.
+    """
+    ovf_name = os.path.basename(ovf_path)
+    disk_name = os.path.basename(disk_path)
+    manifest_name = "%s.mf" % os.path.splitext(ovf_name)[0]
+    with open(ovf_path, 'rb') as ovf_file:
+        ovf_data = ovf_file.read()
+    disk_size = os.path.getsize(disk_path)
+    block_size = os.statvfs(os.path.dirname(os.path.abspath(disk_path))).f_bsize
+    disk_hash = hashlib.new(OVA_MANIFEST_DIGEST)
+    placeholder = '0' * (2 * disk_hash.digest_size)
+    manifest_size = len(
+        ova_manifest([(ovf_name, placeholder), (disk_name, placeholder)]))
+    prefix_size = 3 * tarfile.BLOCKSIZE + len(ovf_data) + \
+        len(ova_member_padding(len(ovf_data))) + manifest_size + \
+        len(ova_member_padding(manifest_size))
+    ovf_data += b' ' * (-prefix_size % block_size)
+    ovf_hash = hashlib.new(OVA_MANIFEST_DIGEST)
+    ovf_hash.update(ovf_data)
+    ovf_digest = ovf_hash.hexdigest()
+    manifest_offset = 2 * tarfile.BLOCKSIZE + len(ovf_data) + \
+        len(ova_member_padding(len(ovf_data)))
+    prefix = ova_member_header(ovf_name, len(ovf_data)) + ovf_data + \
+        ova_member_padding(len(ovf_data)) + \
+        ova_member_header(manifest_name, manifest_size) + \
+        ova_manifest([(ovf_name, ovf_digest), (disk_name, placeholder)]) + \
+        ova_member_padding(manifest_size) + \
+        ova_member_header(disk_name, disk_size)
+    progress = Progress('packaging', ova_path, disk_size)
+
+    def finish_ova(ova_file):
+        ova_file.write(ova_member_padding(disk_size))
+        ova_file.write(b'\0' * 2 * tarfile.BLOCKSIZE)
+        ova_file.seek(manifest_offset)
+        ova_file.write(
+            ova_manifest([(ovf_name, ovf_digest),
+                          (disk_name, disk_hash.hexdigest())]))
+
+    if len(prefix) % block_size == 0 and disk_size > 0 and \
+            insert_file_range(disk_path, len(prefix)):
+        LOG.debug('inserted %d byte OVA prefix in front of %s', len(prefix),
+                  disk_path)
+        with open(disk_path, 'r+b') as ova_file:
+            ova_file.write(prefix)
+            for block in iter(lambda: ova_file.read(OVA_BLOCK_SIZE), b''):
+                disk_hash.update(block)
+                progress.update(len(block))
+            finish_ova(ova_file)
+        os.rename(disk_path, ova_path)
+    else:
+        try:
+            with open(ova_path, 'wb') as ova_file:
+                ova_file.write(prefix)
+                with open(disk_path, 'rb') as disk_file:
+                    for block in iter(lambda: disk_file.read(OVA_BLOCK_SIZE),
+                                      b''):
+                        disk_hash.update(block)
+                        ova_file.write(block)
+                        progress.update(len(block))
+                finish_ova(ova_file)
+        except Exception:
+            if os.path.exists(ova_path):
+                os.remove(ova_path)
+            raise
+        os.remove(disk_path)
+    progress.finish()
 
 
 def clean_ovf(ovf_file_path):
@@ -258,62 +1825,390 @@ def clean_ovf(ovf_file_path):
     os.remove(os.path.join(working_dir, "%s.backup" % file_name))
 
 
-def add_to_manifest(filepath, disk_image):
-    manifest_file_path = "%s.manifest" % disk_image
-    disk_name = os.path.basename(disk_image)
-    if not os.path.exists(manifest_file_path):
-        LOG.info('creating manifest file for %s as %s', disk_name,
+class PatchManifest(object):
+    """Manifest of the files injected into a disk image
+
+    Entries are collected in memory with the size, mode and SHA-256 of
+    the local source file and written once per image. The plain text
+    manifest lists one injected path per line. When MANIFEST_JSON is set
+    a structured manifest with the file details is written beside it.
+    """
+
+    def __init__(self, disk_image):
+        self.disk_image = disk_image
+        self.entries = []
+
+    def add(self, remote_path, local_path):
+        """Add an injected file to the manifest"""
+        local_stat = os.stat(local_path)
+        self.entries.append({
+            'path': remote_path,
+            'size': local_stat.st_size,
+            'mode': "%04o" % stat.S_IMODE(local_stat.st_mode),
+            'sha256': file_digest(local_path, 'sha256')
+        })
+
+    def write(self):
+        """Atomically write the manifest files for the disk image"""
+        if not self.entries:
+            return
+        manifest_file_path = "%s.manifest" % self.disk_image
+        write_atomic(manifest_file_path, ''.join(
+            ["%s\n" % entry['path'] for entry in self.entries]))
+        if MANIFEST_JSON:
+            write_atomic("%s.json" % manifest_file_path, json.dumps({
+                'image': os.path.basename(self.disk_image),
+                'files': self.entries
+            }, indent=2))
+        LOG.info('wrote %d entries to manifest %s', len(self.entries),
                  manifest_file_path)
-    with open(manifest_file_path, 'a+') as mf:
-        LOG.info('adding %s to %s', filepath, manifest_file_path)
-        mf.write("%s\n" % filepath)
 
 
-def generate_md5sum(disk_image):
+def write_atomic(file_path, data):
+    """Write a file through a temporary file renamed into place"""
+    tmp_file_path = "%s.tmp" % file_path
+    with open(tmp_file_path, 'w') as tmp_file:
+        tmp_file.write(data)
+    os.rename(tmp_file_path, file_path)
+
+
+def rename_manifests(disk_image, new_disk_image):
+    """Rename the manifest files of a disk image to follow the image"""
+    for manifest_ext in MANIFEST_EXTS:
+        manifest_file_path = "%s%s" % (disk_image, manifest_ext)
+        if os.path.exists(manifest_file_path):
+            os.rename(manifest_file_path,
+                      "%s%s" % (new_disk_image, manifest_ext))
+
+
+def digest_image(disk_image, algorithms=None):
+    """Read a disk image once, feeding MD5, SHA384 and any extra digests
+
+    Blocks are read sequentially in large buffers and handed to a digest
+    thread through a bounded queue so hashing overlaps disk I/O. Returns
+    a dictionary of hash objects keyed by algorithm name. The sha384 hash
+    object is suitable for direct use by the PKCS1_v1_5 signer.
+    """
+    hashers = {'md5': hashlib.md5(), 'sha384': SHA384.new()}
+    if algorithms:
+        for algorithm in algorithms:
+            if algorithm not in hashers:
+                hashers[algorithm] = hashlib.new(algorithm)
+    LOG.info('calculating %s digests for %s', ', '.join(sorted(hashers)),
+             disk_image)
+    blocks = queue.Queue(maxsize=DIGEST_QUEUE_DEPTH)
+
+    def digest_blocks():
+        while True:
+            block = blocks.get()
+            if block is None:
+                return
+            for hasher in hashers.values():
+                hasher.update(block)
+
+    digest_thread = threading.Thread(target=digest_blocks)
+    digest_thread.start()
+    progress = Progress('digesting', disk_image, os.path.getsize(disk_image))
+    try:
+        with open(disk_image, 'rb') as di:
+            for block in iter(lambda: di.read(DIGEST_BLOCK_SIZE), b''):
+                blocks.put(block)
+                progress.update(len(block))
+    finally:
+        blocks.put(None)
+        digest_thread.join()
+    progress.finish()
+    return hashers
+
+
+def generate_md5sum(disk_image, md5_hash=None):
     """Create MD5 sum file for the disk image"""
     md5_file_path = "%s.md5" % disk_image
     LOG.info('creating md5sum file for %s as %s', disk_image, md5_file_path)
-    md5_hash = hashlib.md5()
-    with open(disk_image, 'rb') as di:
-        for block in iter(lambda: di.read(4096), b''):
-            md5_hash.update(block)
-        with open(md5_file_path, 'w+') as md5sum:
-            md5sum.write(md5_hash.hexdigest())
-
-
-def sign_image(disk_image, private_key):
-    """Creating SHA384 signature digest for disk image"""
-    sig_file_path = "%s.384.sig" % disk_image
-    LOG.info('signing image %s with private key %s', disk_image, private_key)
-    sha384_hash = SHA384.new()
-    with open(disk_image, 'rb') as di:
-        for block in iter(lambda: di.read(4096), b''):
-            sha384_hash.update(block)
-        pk = False
-        with open(private_key, 'r') as key_file:
-            pk = RSA.importKey(key_file.read())
-        signer = PKCS1_v1_5.new(pk)
-        digest = signer.sign(sha384_hash)
-        with open(sig_file_path, 'w+') as sha384sig:
-            sha384sig.write(digest)
-
-
-def wait_for_gfs(gfs_handle):
-    """System settle time for gfs"""
-    time.sleep(5)
-
-
-def validate_bigiq_device(disk_image):
+    if not md5_hash:
+        md5_hash = digest_image(disk_image)['md5']
+    with open(md5_file_path, 'w+') as md5sum:
+        md5sum.write(md5_hash.hexdigest())
+
+
+def generate_digest_files(disk_image, digests, algorithms):
+    """Create <image>.<algorithm> digest files for extra digests"""
+    for algorithm in algorithms:
+        digest_file_path = "%s.%s" % (disk_image, algorithm)
+        LOG.info('creating %s file for %s as %s', algorithm, disk_image,
+                 digest_file_path)
+        with open(digest_file_path, 'w+') as digest_file:
+            digest_file.write(digests[algorithm].hexdigest())
+
+
+class ImageSigner(object):
+    """RSA signer for disk images and their checksum and manifest files
+
+    The private key is read and parsed once, so signing a whole release
+    costs one RSA operation per signature. Disk images are signed from
+    SHA384 digests computed elsewhere in the pipeline. Signatures are
+    written beside the signed file with a .384.sig extension using the
+    PKCS#1 v1.5 or PSS scheme.
+    """
+
+    def __init__(self, private_key_path, scheme=None):
+        self.private_key_path = private_key_path
+        with open(private_key_path, 'r') as key_file:
+            private_key = RSA.importKey(key_file.read())
+        self.scheme = scheme or SIGNATURE_SCHEME
+        self.signer = SIGNATURE_SCHEMES[self.scheme].new(private_key)
+        self.fingerprint = hashlib.sha256(
+            private_key.publickey().exportKey('DER')).hexdigest()
+        self.lock = threading.Lock()
+
+    def sign_digest(self, sha384_hash, sig_file_path):
+        """Sign a SHA384 hash object into a signature file"""
+        with self.lock:
+            signature = self.signer.sign(sha384_hash)
+        sig_tmp_path = "%s.tmp" % sig_file_path
+        with open(sig_tmp_path, 'wb') as sig_file:
+            sig_file.write(signature)
+        os.rename(sig_tmp_path, sig_file_path)
+
+    def sign_image(self, disk_image, sha384_hash=None):
+        """Sign a disk image, reading it only when no digest is given"""
+        LOG.info('signing image %s with private key %s', disk_image,
+                 self.private_key_path)
+        if not sha384_hash:
+            sha384_hash = digest_image(disk_image)['sha384']
+        self.sign_digest(sha384_hash, "%s%s" % (disk_image, SIGNATURE_EXT))
+
+    def sign_file(self, file_path):
+        """Write a detached signature for a small file"""
+        LOG.debug('signing %s', file_path)
+        sha384_hash = SHA384.new()
+        with open(file_path, 'rb') as signed_file:
+            sha384_hash.update(signed_file.read())
+        self.sign_digest(sha384_hash, "%s%s" % (file_path, SIGNATURE_EXT))
+
+
+def is_process_running(pid):
+    """Test if a process is still running, treating zombies as exited"""
+    try:
+        os.kill(pid, 0)
+    except OSError as ex:
+        return ex.errno != errno.ESRCH
+    try:
+        with open("/proc/%d/stat" % pid, 'r') as proc_stat:
+            return proc_stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (IOError, OSError, IndexError):
+        return True
+
+
+def is_image_locked(disk_image):
+    """Test if another process holds a lock on a disk image file
+
+    qemu takes byte range locks on the image files it opens. A
+    non-blocking exclusive lock attempt conflicts with any of them.
+    """
+    try:
+        fd = os.open(disk_image, os.O_RDWR)
+    except OSError:
+        return False
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+        return False
+    except (IOError, OSError):
+        return True
+    finally:
+        os.close(fd)
+
+
+def wait_for_gfs(disk_image, appliance_pid=None, timeout=None):
+    """Wait for the appliance to exit and release the disk image
+
+    Polls with exponential backoff until the appliance process has
+    exited and the disk image lock is released, returning the number of
+    seconds waited.
+    """
+    if not timeout:
+        timeout = GFS_SETTLE_TIMEOUT
+    start_time = time.time()
+    delay = GFS_SETTLE_MIN_DELAY
+    while True:
+        running = appliance_pid and is_process_running(appliance_pid)
+        if not running and not is_image_locked(disk_image):
+            break
+        if time.time() - start_time > timeout:
+            LOG.warn('guestfs did not release %s in %s seconds', disk_image,
+                     timeout)
+            break
+        time.sleep(delay)
+        delay = min(delay * 2, GFS_SETTLE_MAX_DELAY)
+    settle_time = time.time() - start_time
+    LOG.info('guestfs released %s after %.3f seconds', disk_image,
+             settle_time)
+    return settle_time
+
+
+class PatchSession(object):
+    """Single libguestfs appliance session used to patch a disk image
+
+    The appliance is launched once per disk image. Each BIG-IQ file
+    system is then mounted at / in turn, patched and unmounted again
+    inside the same handle. A session created for a BatchSession drive
+    shares the batch appliance instead of launching its own.
+    """
+
+    def __init__(self, disk_image, drive_image=None, batch=None):
+        self.disk_image = disk_image
+        self.drive_image = drive_image or disk_image
+        self.batch = batch
+        self.gfs = None
+        self.mounted_dev = None
+        self.settle_time = None
+        self.manifest = PatchManifest(disk_image)
+
+    def __enter__(self):
+        self.launch()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def launch(self):
+        """Launch the libguestfs appliance with the disk image attached"""
+        if self.batch:
+            self.batch.launch()
+            self.gfs = self.batch.gfs
+        if not self.gfs:
+            LOG.debug('launching guestfs appliance for %s', self.drive_image)
+            start_time = time.time()
+            self.gfs = guestfs.GuestFS(python_return_dict=True)
+            self.gfs.add_drive_opts(self.drive_image)
+            self.gfs.launch()
+            record_stage(self.disk_image, 'launch', start_time)
+
+    def mount(self, dev):
+        """Mount a file system device at / in the appliance"""
+        if self.mounted_dev == dev:
+            return
+        self.umount()
+        LOG.debug('mounting %s from %s', dev, self.disk_image)
+        self.gfs.mount(dev, '/')
+        self.mounted_dev = dev
+
+    def umount(self):
+        """Sync and unmount the currently mounted file system"""
+        if self.mounted_dev:
+            LOG.debug('unmounting %s from %s', self.mounted_dev,
+                      self.disk_image)
+            self.gfs.sync()
+            self.gfs.umount_all()
+            self.mounted_dev = None
+
+    def close(self):
+        """Unmount, shutdown and close the libguestfs appliance"""
+        if self.batch:
+            self.umount()
+            self.gfs = None
+        if self.gfs:
+            start_time = time.time()
+            self.umount()
+            self.gfs.sync()
+            try:
+                appliance_pid = self.gfs.get_pid()
+            except Exception:
+                appliance_pid = None
+            self.gfs.shutdown()
+            self.gfs.close()
+            self.gfs = None
+            self.settle_time = wait_for_gfs(self.drive_image, appliance_pid)
+            record_stage(self.disk_image, 'shutdown', start_time,
+                         settle_seconds=round(self.settle_time, 3))
+
+
+class BatchSession(object):
+    """libguestfs appliance session with several disk images attached
+
+    The appliance is launched once for the whole batch. Each drive is
+    then patched through its own PatchSession sharing the appliance.
+    """
+
+    def __init__(self, disk_images, drive_images):
+        self.disk_images = disk_images
+        self.drive_images = drive_images
+        self.gfs = None
+
+    def __enter__(self):
+        self.launch()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def launch(self):
+        """Launch the libguestfs appliance with every drive attached"""
+        if not self.gfs:
+            LOG.debug('launching guestfs appliance for %d drives',
+                      len(self.drive_images))
+            start_time = time.time()
+            self.gfs = guestfs.GuestFS(python_return_dict=True)
+            for drive_image in self.drive_images:
+                self.gfs.add_drive_opts(drive_image)
+            self.gfs.launch()
+            for disk_image in self.disk_images:
+                record_stage(disk_image, 'launch', start_time,
+                             drives=len(self.drive_images))
+
+    def session(self, index):
+        """Return the patch session of the drive at an index
+
+        The LVM filter is narrowed to the drive so only its volume groups
+        are active while it is patched.
+        """
+        self.gfs.umount_all()
+        self.gfs.lvm_set_filter([self.gfs.list_devices()[index]])
+        return PatchSession(self.disk_images[index], self.drive_images[index],
+                            self)
+
+    def close(self):
+        """Unmount, shutdown and close the libguestfs appliance"""
+        if self.gfs:
+            start_time = time.time()
+            self.gfs.umount_all()
+            self.gfs.sync()
+            try:
+                appliance_pid = self.gfs.get_pid()
+            except Exception:
+                appliance_pid = None
+            self.gfs.shutdown()
+            self.gfs.close()
+            self.gfs = None
+            for (disk_image, drive_image) in zip(self.disk_images,
+                                                 self.drive_images):
+                settle_time = wait_for_gfs(drive_image, appliance_pid)
+                record_stage(disk_image, 'shutdown', start_time,
+                             settle_seconds=round(settle_time, 3),
+                             drives=len(self.drive_images))
+
+
+def validate_bigiq_device(session):
     """Validate disk image has BIGIQ volumes"""
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
+    inspection = classify_bigiq_filesystems(session.gfs.list_filesystems())
+    if not inspection[0]:
+        LOG.warn('%s is not a BIGIQ image file.. skipping..',
+                 session.disk_image)
+    return inspection
+
+
+def classify_bigiq_filesystems(file_systems):
+    """Find the BIGIQ volumes in a list of file system devices
+
+    Returns an (is_bigiq, config_dev, usr_dev, var_dev, shared_dev) tuple.
+    """
     is_bigiq = False
     config_dev = None
     usr_dev = None
     var_dev = None
     shared_dev = None
-    for file_system in gfs.list_filesystems():
+    for file_system in file_systems:
         if '_config' in file_system:
             is_bigiq = True
             config_dev = file_system
@@ -323,15 +2218,280 @@ def validate_bigiq_device(disk_image):
             var_dev = file_system
         if 'share' in file_system:
             shared_dev = file_system
-    if not is_bigiq:
-        LOG.warn('%s is not a BIGIQ image file.. skipping..', disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
     return (is_bigiq, config_dev, usr_dev, var_dev, shared_dev)
 
 
+def image_header_key(disk_image):
+    """Return an inspection key from a disk image size, head and tail"""
+    image_size = os.path.getsize(disk_image)
+    header_hash = hashlib.sha256(str(image_size).encode('utf8'))
+    with open(disk_image, 'rb') as image_file:
+        header_hash.update(image_file.read(INSPECT_HEADER_SIZE))
+        image_file.seek(max(image_size - INSPECT_HEADER_SIZE, 0))
+        header_hash.update(image_file.read(INSPECT_HEADER_SIZE))
+    return header_hash.hexdigest()
+
+
+class InspectionCache(object):
+    """JSON file cache of the BIGIQ volumes discovered in disk images
+
+    Entries are keyed by image_header_key and hold the tuple returned by
+    validate_bigiq_device. Updates are serialized between patch worker
+    processes with a lock on the cache file.
+    """
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+
+    def load(self):
+        """Load the cache entries"""
+        if not os.path.exists(self.cache_path):
+            return {}
+        with open(self.cache_path, 'r') as cache_file:
+            return json.load(cache_file)
+
+    def get(self, inspect_key):
+        """Return the cached inspection of a disk image or None"""
+        inspection = self.load().get(inspect_key)
+        if inspection:
+            LOG.debug('using cached inspection %s', inspect_key)
+            return tuple(inspection)
+        return None
+
+    def put(self, inspect_key, inspection):
+        """Add the inspection of a disk image to the cache"""
+        with open("%s.lock" % self.cache_path, 'w') as lock_file:
+            fcntl.lockf(lock_file, fcntl.LOCK_EX)
+            entries = self.load()
+            entries[inspect_key] = list(inspection)
+            write_atomic(self.cache_path, json.dumps(entries, indent=2))
+
+
+def inspect_disk_header(disk_image):
+    """Discover BIGIQ volumes from the LVM metadata on a disk image
+
+    Returns the validate_bigiq_device tuple, or None when the image
+    format or disk layout can not be read without the appliance.
+    """
+    try:
+        reader = open_disk_reader(disk_image)
+        if not reader:
+            return None
+        devices = read_lvm_devices(reader)
+    except (IOError, OSError, ValueError, struct.error) as ex:
+        LOG.debug('could not read LVM metadata from %s: %s', disk_image, ex)
+        return None
+    if not devices:
+        return None
+    LOG.debug('read LVM volumes %s from %s', devices, disk_image)
+    return classify_bigiq_filesystems(devices)
+
+
+def vhd_footer_disk_type(footer):
+    """Return the disk type of a VHD footer, or None for other formats"""
+    if footer[0:8] != VHD_COOKIE:
+        return None
+    return struct.unpack('>I', footer[60:64])[0]
+
+
+def vhd_disk_type(disk_image):
+    """Return the disk type recorded in the footer of a VHD disk image"""
+    image_size = os.path.getsize(disk_image)
+    with open(disk_image, 'rb') as image_file:
+        image_file.seek(max(image_size - SECTOR_SIZE, 0))
+        return vhd_footer_disk_type(image_file.read(SECTOR_SIZE))
+
+
+def open_disk_reader(disk_image):
+    """Return a function reading guest disk bytes from a disk image
+
+    Fixed VHD and qcow2 images, including qcow2 overlays, are supported.
+    Returns None for any other disk image format.
+    """
+    image_size = os.path.getsize(disk_image)
+    with open(disk_image, 'rb') as image_file:
+        magic = image_file.read(4)
+        image_file.seek(max(image_size - SECTOR_SIZE, 0))
+        footer = image_file.read(SECTOR_SIZE)
+    if magic == b'QFI\xfb':
+        return qcow2_reader(disk_image)
+    if vhd_footer_disk_type(footer) == VHD_FIXED_DISK:
+
+        def read_vhd(offset, length):
+            with open(disk_image, 'rb') as image_file:
+                image_file.seek(offset)
+                return image_file.read(length)
+
+        return read_vhd
+    return None
+
+
+def qcow2_reader(disk_image):
+    """Return a function reading guest disk bytes from a qcow2 image"""
+    with open(disk_image, 'rb') as image_file:
+        header = image_file.read(104)
+    (magic, version, backing_file_offset, backing_file_size, cluster_bits,
+     disk_size, crypt_method, l1_size,
+     l1_table_offset) = struct.unpack('>4sIQIIQIIQ', header[0:48])
+    if crypt_method:
+        raise ValueError('encrypted qcow2 images are not supported')
+    if version > 2 and struct.unpack('>Q', header[72:80])[0] & ~0x3:
+        raise ValueError('qcow2 incompatible features are not supported')
+    backing_reader = None
+    if backing_file_offset:
+        with open(disk_image, 'rb') as image_file:
+            image_file.seek(backing_file_offset)
+            backing_file = image_file.read(backing_file_size).decode('utf8')
+        backing_reader = open_disk_reader(
+            os.path.join(os.path.dirname(disk_image), backing_file))
+        if not backing_reader:
+            raise ValueError("unsupported backing file %s" % backing_file)
+    cluster_size = 1 << cluster_bits
+    l2_entries = cluster_size // 8
+    offset_mask = 0x00fffffffffffe00
+
+    def read_qcow2(offset, length):
+        data = b''
+        with open(disk_image, 'rb') as image_file:
+            while length > 0 and offset < disk_size:
+                in_cluster = offset % cluster_size
+                chunk = min(length, cluster_size - in_cluster)
+                cluster_index = offset // cluster_size
+                l1_index = cluster_index // l2_entries
+                cluster_offset = 0
+                zero_cluster = False
+                if l1_index < l1_size:
+                    image_file.seek(l1_table_offset + 8 * l1_index)
+                    l2_table_offset = struct.unpack(
+                        '>Q', image_file.read(8))[0] & offset_mask
+                    if l2_table_offset:
+                        image_file.seek(l2_table_offset +
+                                        8 * (cluster_index % l2_entries))
+                        l2_entry = struct.unpack('>Q', image_file.read(8))[0]
+                        if l2_entry & (1 << 62):
+                            raise ValueError(
+                                'compressed qcow2 clusters are not supported')
+                        cluster_offset = l2_entry & offset_mask
+                        zero_cluster = bool(l2_entry & 1)
+                if cluster_offset and not zero_cluster:
+                    image_file.seek(cluster_offset + in_cluster)
+                    data += image_file.read(chunk)
+                elif backing_reader and not zero_cluster:
+                    data += backing_reader(offset, chunk)
+                else:
+                    data += b'\0' * chunk
+                offset += chunk
+                length -= chunk
+        return data
+
+    return read_qcow2
+
+
+def read_lvm_devices(reader):
+    """Return /dev/<vg>/<lv> devices from the LVM metadata on a disk
+
+    Physical volumes are looked for on the whole disk and on every MBR
+    or GPT partition.
+    """
+    devices = []
+    for pv_offset in list_partition_offsets(reader):
+        metadata = read_lvm_metadata(reader, pv_offset)
+        if metadata:
+            (vg_name, lv_names) = parse_lvm_metadata(metadata)
+            for lv_name in lv_names:
+                devices.append("/dev/%s/%s" % (vg_name, lv_name))
+    return devices
+
+
+def list_partition_offsets(reader):
+    """Return the byte offsets of the whole disk and its partitions"""
+    offsets = [0]
+    mbr = reader(0, SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != b'\x55\xaa':
+        return offsets
+    for index in range(4):
+        entry = mbr[446 + 16 * index:462 + 16 * index]
+        partition_type = entry[4:5]
+        first_lba = struct.unpack('<I', entry[8:12])[0]
+        if partition_type == b'\xee':
+            gpt_header = reader(SECTOR_SIZE, SECTOR_SIZE)
+            if gpt_header[0:8] != b'EFI PART':
+                continue
+            (entries_lba, entry_count,
+             entry_size) = struct.unpack('<QII', gpt_header[72:88])
+            entries = reader(entries_lba * SECTOR_SIZE,
+                             entry_count * entry_size)
+            for gpt_index in range(entry_count):
+                gpt_entry = entries[gpt_index * entry_size:(gpt_index + 1) *
+                                    entry_size]
+                if gpt_entry[0:16] != b'\0' * 16:
+                    offsets.append(
+                        struct.unpack('<Q', gpt_entry[32:40])[0] *
+                        SECTOR_SIZE)
+        elif partition_type != b'\0' and first_lba:
+            offsets.append(first_lba * SECTOR_SIZE)
+    return offsets
+
+
+def read_lvm_metadata(reader, pv_offset):
+    """Return the current LVM metadata text of a physical volume or None"""
+    label = reader(pv_offset, LVM_LABEL_SECTORS * SECTOR_SIZE)
+    for sector in range(LVM_LABEL_SECTORS):
+        sector_data = label[sector * SECTOR_SIZE:(sector + 1) * SECTOR_SIZE]
+        if sector_data[0:8] == b'LABELONE' and \
+                sector_data[24:32] == b'LVM2 001':
+            break
+    else:
+        return None
+    pv_header_offset = pv_offset + sector * SECTOR_SIZE + struct.unpack(
+        '<I', sector_data[20:24])[0]
+    pv_header = reader(pv_header_offset, SECTOR_SIZE)
+    locations = []
+    position = 40
+    for area_list in range(2):
+        while True:
+            (area_offset, area_size) = struct.unpack(
+                '<QQ', pv_header[position:position + 16])
+            position += 16
+            if not area_offset:
+                break
+            if area_list:
+                locations.append((area_offset, area_size))
+    for (mda_offset, mda_size) in locations:
+        mda_header = reader(pv_offset + mda_offset, LVM_MDA_HEADER_SIZE)
+        if mda_header[4:20] != b' LVM2 x[5A%r0N*>':
+            continue
+        (text_offset, text_size) = struct.unpack('<QQ', mda_header[40:56])
+        if not text_offset:
+            continue
+        first_size = min(text_size, mda_size - text_offset)
+        text = reader(pv_offset + mda_offset + text_offset, first_size)
+        if first_size < text_size:
+            text += reader(pv_offset + mda_offset + LVM_MDA_HEADER_SIZE,
+                           text_size - first_size)
+        return text.rstrip(b'\0').decode('utf8', 'replace')
+    return None
+
+
+def parse_lvm_metadata(metadata):
+    """Return the volume group name and logical volume names of metadata"""
+    vg_name = None
+    lv_names = []
+    sections = []
+    for line in metadata.splitlines():
+        line = line.strip()
+        if line.endswith('{'):
+            section = line[:-1].strip()
+            if not sections:
+                vg_name = section
+            elif sections == [vg_name, 'logical_volumes']:
+                lv_names.append(section)
+            sections.append(section)
+        elif line.startswith('}') and sections:
+            sections.pop()
+    return (vg_name, lv_names)
+
+
 def update_cloudinit_modules(bigiq_cloudinit_dir):
     """Get latest cloudinit"""
     LOG.info('pulling latest cloudinit modules')
@@ -343,152 +2503,98 @@ def update_cloudinit_modules(bigiq_cloudinit_dir):
     os.chdir(start_directory)
 
 
-def inject_cloudinit_modules(disk_image, bigiq_cloudinit_dir, dev):
-    """Inject cloudinit modules into BIGIQ disk image"""
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    python_system_path = '/local/lib/python2.7'
-    LOG.debug('injecting files into /usr%s' % python_system_path)
-    bigiq_cc_path = "%s/image_patch_files/system_python_path" % bigiq_cloudinit_dir
-    bigiq_cc_files = []
-    for root, dirs, files in os.walk(bigiq_cc_path):
-        for file_name in files:
-            bigiq_cc_files.append(
-                os.path.join(root, file_name)[len(bigiq_cc_path):])
-    for bigiq_cc_file in bigiq_cc_files:
-        local = "%s%s" % (bigiq_cc_path, bigiq_cc_file)
-        remote = "%s%s" % (python_system_path, bigiq_cc_file)
-        LOG.debug('injecting %s to /usr%s', os.path.basename(local), remote)
-        mkdir_path = os.path.dirname(remote)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, remote)
-        add_to_manifest("/usr%s" % remote, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_cloudinit_config_template(disk_image, bigiq_cloudinit_dir,
-                                     cloud_template_file,dev):
+def inject_cloudinit_config_template(session, cloud_template_file, dev):
     """Inject cloudinit configuration template into BIG-IQ disk image"""
     LOG.debug('injecting cloudinit configuration template %s' %
               cloud_template_file)
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    mkdir_path = '/share/defaults/config/templates'
-    dest_template_file = "%s/cloud-init.tmpl" % mkdir_path
-    gfs.mkdir_p(mkdir_path)
-    gfs.upload(cloud_template_file, dest_template_file)
-    add_to_manifest("/usr%s" % dest_template_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_usr_files(disk_image, usr_dir, dev):
-    """Patch /usr file system of a BIGIQ disk image"""
-    LOG.debug('injecting files into /usr')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    usr_files = []
-    for root, dirs, files in os.walk(usr_dir):
-        for file_name in files:
-            usr_files.append(os.path.join(root, file_name)[len(usr_dir):])
-    for usr_file in usr_files:
-        local = "%s%s" % (usr_dir, usr_file)
-        LOG.debug('injecting %s to /usr%s', os.path.basename(local), usr_file)
-        mkdir_path = os.path.dirname(usr_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, usr_file)
-        add_to_manifest("/usr%s" % usr_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_var_files(disk_image, var_dir, dev):
-    """Patch /var file system of a BIGIQ disk image"""
-    LOG.debug('injecting files into /var')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    var_files = []
-    for root, dirs, files in os.walk(var_dir):
-        for file_name in files:
-            var_files.append(os.path.join(root, file_name)[len(var_dir):])
-    for var_file in var_files:
-        local = "%s%s" % (var_dir, var_file)
-        LOG.debug('injecting %s to /var%s', os.path.basename(local), var_file)
-        mkdir_path = os.path.dirname(var_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, var_file)
-        add_to_manifest("/var%s" % var_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_shared_files(disk_image, shared_dir, dev):
-    """Patch /shared file system of a BIGIQ disk image"""
-    LOG.debug('injecting files into /shared')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    shared_files = []
-    for root, dirs, files in os.walk(shared_dir):
-        for file_name in files:
-            shared_files.append(
-                os.path.join(root, file_name)[len(shared_dir):])
-    for shared_file in shared_files:
-        local = "%s%s" % (shared_dir, shared_file)
-        LOG.debug('injecting %s to /shared%s', os.path.basename(local),
-                  shared_file)
-        mkdir_path = os.path.dirname(shared_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, shared_file)
-        add_to_manifest("/shared%s" % shared_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
-
-
-def inject_config_files(disk_image, config_dir, dev):
-    """Patch /config file system of a BIGIQ disk image"""
-    LOG.debug('injecting files into /config')
-    gfs = guestfs.GuestFS(python_return_dict=True)
-    gfs.add_drive_opts(disk_image)
-    gfs.launch()
-    gfs.mount(dev, '/')
-    config_files = []
-    for root, dirs, files in os.walk(config_dir):
+    session.mount(dev)
+    dest_template_file = "%s/cloud-init.tmpl" % CLOUDINIT_TEMPLATE_DIR
+    session.gfs.mkdir_p(CLOUDINIT_TEMPLATE_DIR)
+    start_time = time.time()
+    session.gfs.upload(cloud_template_file, dest_template_file)
+    session.manifest.add("/usr%s" % dest_template_file, cloud_template_file)
+    record_stage(session.disk_image, 'inject_cloudinit_config_template',
+                 start_time, os.path.getsize(cloud_template_file), 1)
+
+
+def list_inject_files(local_dir):
+    """List files in a local injection tree relative to the tree root"""
+    inject_files = []
+    for root, dirs, files in os.walk(local_dir):
         for file_name in files:
-            config_files.append(
-                os.path.join(root, file_name)[len(config_dir):])
-    for config_file in config_files:
-        local = "%s%s" % (config_dir, config_file)
-        LOG.debug('injecting %s to /config%s', os.path.basename(local),
-                  config_file)
-        mkdir_path = os.path.dirname(config_file)
-        gfs.mkdir_p(mkdir_path)
-        gfs.upload(local, config_file)
-        add_to_manifest("/config%s" % config_file, disk_image)
-    gfs.sync()
-    gfs.shutdown()
-    gfs.close()
-    wait_for_gfs(gfs)
+            inject_files.append(
+                os.path.join(root, file_name)[len(local_dir):])
+    return inject_files
+
+
+def build_inject_tar(local_dir):
+    """Build a tar archive of a local injection tree
+
+    Members are owned by root and keep their local file modes. Only file
+    members are added so existing directories in the disk image keep
+    their ownership and modes. Returns the tar file path and the list
+    of member names.
+    """
+    tar_file = tempfile.NamedTemporaryFile(prefix='bigiq_inject_',
+                                           suffix='.tar', delete=False)
+    with tarfile.open(fileobj=tar_file, mode='w',
+                      format=tarfile.GNU_FORMAT) as archive:
+        for inject_file in list_inject_files(local_dir):
+            local = "%s%s" % (local_dir, inject_file)
+            member = archive.gettarinfo(local, arcname=inject_file.lstrip('/'))
+            member.uid = 0
+            member.gid = 0
+            member.uname = 'root'
+            member.gname = 'root'
+            if member.isreg():
+                with open(local, 'rb') as local_file:
+                    archive.addfile(member, local_file)
+            else:
+                archive.addfile(member)
+        member_names = archive.getnames()
+    tar_file.close()
+    return (tar_file.name, member_names)
+
+
+def inject_files(session, local_dir, dev, mount_point, remote_dir='/',
+                 stage=None):
+    """Patch a file system of a BIGIQ disk image from a local directory"""
+    LOG.debug('injecting files into %s%s', mount_point,
+              remote_dir.rstrip('/'))
+    start_time = time.time()
+    session.mount(dev)
+    if INJECT_MODE == 'tar':
+        (tar_file_path, member_names) = build_inject_tar(local_dir)
+        try:
+            session.gfs.mkdir_p(remote_dir)
+            session.gfs.tar_in(tar_file_path, remote_dir)
+        finally:
+            os.unlink(tar_file_path)
+        LOG.debug('injected %d files to %s%s', len(member_names), mount_point,
+                  remote_dir.rstrip('/'))
+        for member_name in member_names:
+            session.manifest.add(
+                "%s%s/%s" % (mount_point, remote_dir.rstrip('/'),
+                             member_name), os.path.join(local_dir,
+                                                        member_name))
+    else:
+        for inject_file in list_inject_files(local_dir):
+            local = "%s%s" % (local_dir, inject_file)
+            remote = "%s%s" % (remote_dir.rstrip('/'), inject_file)
+            LOG.debug('injecting %s to %s%s', os.path.basename(local),
+                      mount_point, remote)
+            mkdir_path = os.path.dirname(remote)
+            session.gfs.mkdir_p(mkdir_path)
+            session.gfs.upload(local, remote)
+            session.manifest.add("%s%s" % (mount_point, remote), local)
+    inject_file_paths = [
+        "%s%s" % (local_dir, inject_file)
+        for inject_file in list_inject_files(local_dir)
+    ]
+    record_stage(session.disk_image,
+                 stage or "inject_%s" % mount_point.strip('/'), start_time,
+                 sum([os.path.getsize(path) for path in inject_file_paths]),
+                 len(inject_file_paths))
 
 
 if __name__ == "__main__":
@@ -510,6 +2616,49 @@ if __name__ == "__main__":
     PRIVATE_PEM_KEY_FILE = os.getenv('PRIVATE_PEM_KEY_FILE', None)
     IMAGE_OVERWRITE = os.getenv('IMAGE_OVERWRITE', '0')
     IMAGE_BUILD_ID = os.getenv('IMAGE_BUILD_ID', None)
+    BIGIQ_PATCH_CACHE_DIR = os.getenv('BIGIQ_PATCH_CACHE_DIR', None)
+    INJECT_MODE = os.getenv('BIGIQ_INJECT_MODE', INJECT_MODE).lower()
+    if INJECT_MODE not in ['tar', 'upload']:
+        LOG.error("BIGIQ_INJECT_MODE must be either tar or upload")
+        sys.exit(1)
+    OVERLAY_MODE = os.getenv('BIGIQ_OVERLAY_MODE', 'false').lower() in [
+        '1', 'yes', 'true'
+    ]
+    MANIFEST_JSON = os.getenv('BIGIQ_MANIFEST_JSON', 'false').lower() in [
+        '1', 'yes', 'true'
+    ]
+    if OVERLAY_MODE:
+        LOG.info("Patching qcow2 overlays of pristine images in: %s/%s",
+                 BIGIQ_IMAGE_DIR, OVERLAY_BASE_DIR)
+    VMDK_CONVERTER = os.getenv('BIGIQ_VMDK_CONVERTER', VMDK_CONVERTER)
+    if VMDK_CONVERTER not in VMDK_CONVERTERS:
+        LOG.error("BIGIQ_VMDK_CONVERTER must be one of: %s",
+                  ', '.join(sorted(VMDK_CONVERTERS)))
+        sys.exit(1)
+    PROGRESS_JSON_FILE = os.getenv('BIGIQ_PROGRESS_JSON', None)
+    QEMU_IMG_COROUTINES = int(
+        os.getenv('BIGIQ_QEMU_IMG_COROUTINES', QEMU_IMG_COROUTINES))
+    BIGIQ_PATCH_WORKERS = int(os.getenv('BIGIQ_PATCH_WORKERS', '1'))
+    BIGIQ_PATCH_BATCH = int(os.getenv('BIGIQ_PATCH_BATCH', '1'))
+    SIGNATURE_SCHEME = os.getenv('BIGIQ_SIGNATURE_SCHEME',
+                                 SIGNATURE_SCHEME).lower()
+    if SIGNATURE_SCHEME not in SIGNATURE_SCHEMES:
+        LOG.error("BIGIQ_SIGNATURE_SCHEME must be one of: %s",
+                  ', '.join(sorted(SIGNATURE_SCHEMES)))
+        sys.exit(1)
+    BIGIQ_INCREMENTAL = os.getenv('BIGIQ_INCREMENTAL', 'false').lower() in [
+        '1', 'yes', 'true'
+    ]
+    if BIGIQ_INCREMENTAL:
+        MANIFEST_JSON = True
+    BIGIQ_DRY_RUN = os.getenv('BIGIQ_DRY_RUN', 'false').lower() in [
+        '1', 'yes', 'true'
+    ]
+    IMAGE_DIGESTS = [
+        digest.strip().lower()
+        for digest in os.getenv('IMAGE_DIGESTS', '').split(',')
+        if digest.strip() and digest.strip().lower() not in ['md5', 'sha384']
+    ]
     BIGIQ_CLOUDINIT_CONFIG_TEMPLATE = os.getenv(
         'BIGIQ_CLOUDINIT_CONFIG_TEMPLATE',
         '/bigiq-cloudinit/image_patch_files/cloudinit_configs/disable_cloudinit/cloud-init.tmpl')
@@ -545,19 +2694,45 @@ if __name__ == "__main__":
             "%s/%s" % (PRIVATE_PEM_KEY_DIR, PRIVATE_PEM_KEY_FILE)):
         PRIVATE_KEY_PATH = "%s/%s" % (PRIVATE_PEM_KEY_DIR,
                                       PRIVATE_PEM_KEY_FILE)
+    if BIGIQ_PATCH_CACHE_DIR:
+        LOG.info("Caching patched image artifacts in: %s",
+                 BIGIQ_PATCH_CACHE_DIR)
     if IMAGE_OVERWRITE == "1" or IMAGE_OVERWRITE.lower(
     ) == 'yes' or IMAGE_OVERWRITE.lower() == 'true':
         IMAGE_OVERWRITE = True
         LOG.info('force overwrite of existing patch file artifacts')
     else:
         IMAGE_OVERWRITE = False
-    patch_images(BIGIQ_IMAGE_DIR, BIGIQ_CLOUDINIT_DIR, BIGIQ_USR_INJECT_DIR,
-                 BIGIQ_VAR_INJECT_DIR, BIGIQ_CONFIG_INJECT_DIR,
-                 BIGIQ_SHARED_INJECT_DIR, PRIVATE_KEY_PATH, 
-                 BIGIQ_CLOUDINIT_CONFIG_TEMPLATE, IMAGE_OVERWRITE, IMAGE_BUILD_ID)
+    for IMAGE_DIGEST in IMAGE_DIGESTS:
+        if IMAGE_DIGEST not in hashlib.algorithms_available:
+            LOG.error("Unsupported image digest algorithm: %s", IMAGE_DIGEST)
+            sys.exit(1)
+    if IMAGE_DIGESTS:
+        LOG.info("Generating additional image digests: %s",
+                 ', '.join(IMAGE_DIGESTS))
+    if BIGIQ_PATCH_WORKERS > 1:
+        LOG.info("Patching with up to %d worker processes",
+                 BIGIQ_PATCH_WORKERS)
+    if BIGIQ_PATCH_BATCH > 1:
+        LOG.info("Patching up to %d images in each appliance",
+                 BIGIQ_PATCH_BATCH)
+    if BIGIQ_INCREMENTAL:
+        LOG.info("Incrementally patching previously patched images")
+    if BIGIQ_DRY_RUN:
+        LOG.info("Dry run, planning the patch run without patching images")
+    RESULTS = patch_images(BIGIQ_IMAGE_DIR, BIGIQ_CLOUDINIT_DIR,
+                           BIGIQ_USR_INJECT_DIR, BIGIQ_VAR_INJECT_DIR,
+                           BIGIQ_CONFIG_INJECT_DIR, BIGIQ_SHARED_INJECT_DIR,
+                           PRIVATE_KEY_PATH, BIGIQ_CLOUDINIT_CONFIG_TEMPLATE,
+                           IMAGE_OVERWRITE, IMAGE_BUILD_ID,
+                           BIGIQ_PATCH_WORKERS, IMAGE_DIGESTS,
+                           BIGIQ_PATCH_CACHE_DIR, BIGIQ_DRY_RUN,
+                           BIGIQ_PATCH_BATCH, BIGIQ_INCREMENTAL)
     STOP_TIME = time.time()
     DURATION = STOP_TIME - START_TIME
     LOG.debug(
         'process end time: %s - ran %s (seconds)',
         datetime.datetime.fromtimestamp(STOP_TIME).strftime(
             "%A, %B %d, %Y %I:%M:%S"), DURATION)
+    if [result for result in RESULTS if not result[1]]:
+        sys.exit(1)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+# coding=utf-8
+# pylint: disable=broad-except,line-too-long
+# Copyright (c) 2016-2018, F5 Networks, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+This module times each VMDK conversion backend of the image patcher
+against a copy of the same source VMDK disk image.
+
+usage: compare_vmdk_converters.py <vmdk image> [variant ...]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import bigiq_image_patcher
+
+DEFAULT_VARIANTS = [
+    bigiq_image_patcher.VBOXMANAGE_CLI_PATCH_VARIANT,
+    bigiq_image_patcher.VBOXMANAGE_CLI_OUTPUT_VARIANT
+]
+
+
+def compare_converters(vmdk_image, variants):
+    """Convert a copy of a VMDK with every backend, returning timings"""
+    timings = []
+    for converter_name in sorted(bigiq_image_patcher.VMDK_CONVERTERS):
+        converter = bigiq_image_patcher.get_vmdk_converter(converter_name)
+        for variant in variants:
+            work_dir = tempfile.mkdtemp(prefix='vmdk_compare_',
+                                        dir=os.path.dirname(
+                                            os.path.abspath(vmdk_image)))
+            try:
+                work_image = os.path.join(work_dir,
+                                          os.path.basename(vmdk_image))
+                shutil.copy(vmdk_image, work_image)
+                start_time = time.time()
+                try:
+                    bigiq_image_patcher.convert_vmdk(work_image, variant,
+                                                     converter)
+                    duration = time.time() - start_time
+                    timings.append((converter_name, variant, duration,
+                                    os.path.getsize(work_image), None))
+                except Exception as ex:
+                    timings.append((converter_name, variant,
+                                    time.time() - start_time, 0, str(ex)))
+            finally:
+                shutil.rmtree(work_dir)
+    return timings
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: %s <vmdk image> [variant ...]" % sys.argv[0])
+        sys.exit(1)
+    VMDK_IMAGE = sys.argv[1]
+    VARIANTS = sys.argv[2:] or DEFAULT_VARIANTS
+    print("%-12s %-10s %12s %16s" % ('converter', 'variant', 'seconds',
+                                     'output bytes'))
+    for (CONVERTER, VARIANT, DURATION, SIZE, ERROR) in compare_converters(
+            VMDK_IMAGE, VARIANTS):
+        if ERROR:
+            print("%-12s %-10s %12.1f failed: %s" % (CONVERTER, VARIANT,
+                                                     DURATION, ERROR))
+        else:
+            print("%-12s %-10s %12.1f %16d" % (CONVERTER, VARIANT, DURATION,
+                                               SIZE))
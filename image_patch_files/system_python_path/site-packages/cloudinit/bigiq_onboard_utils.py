@@ -27,6 +27,11 @@ import subprocess
 import urlparse
 import socket
 import time
+import signal
+import select
+import random
+import struct
+import calendar
 import requests
 import yaml
 import shutil
@@ -47,12 +52,39 @@ BIGSTART_DELAY = 5
 ICONTROL_TIMEOUT = 600
 URL_TIMEOUT = 600
 BOOT_CLOUDINIT_DELAY = 5
+DHCP_POLL_INTERVAL = 0.5
+DHCP_RETRANSMIT_INTERVAL = 4
 
 MGMT_DHCP_LEASE_FILE = '/var/lib/dhclient/dhclient.leases'
 
 ANSIBLE_VAR_FILE = '/var/lib/cloud/ansible/onboard/onboard_vars.yml'
 
 DHCP_LEASE_DIR = OUT_DIR + '/dhclient'
+DHCLIENT_CONF_FILE = DHCP_LEASE_DIR + '/dhclient.conf'
+DHCLIENT_CONF = (
+    "\nrequest subnet-mask, broadcast-address, time-offset, routers,\n"
+    "        domain-name, domain-name-servers, domain-search, host-name,\n"
+    "        root-path, interface-mtu, classless-static-routes;\n")
+
+DHCP_CLIENT_PORT = 68
+DHCP_SERVER_PORT = 67
+DHCP_MAGIC_COOKIE = 0x63825363
+# not exported by the python 2 socket module
+SO_BINDTODEVICE = 25
+# requested DHCPv4 options, by code, named as dhclient writes them
+DHCP4_OPTIONS = {
+    1: ('subnet-mask', 'ip'),
+    3: ('routers', 'ips'),
+    6: ('domain-name-servers', 'ips'),
+    12: ('host-name', 'string'),
+    15: ('domain-name', 'string'),
+    26: ('interface-mtu', 'uint16'),
+    28: ('broadcast-address', 'ip'),
+    42: ('ntp-servers', 'ips'),
+    51: ('dhcp-lease-time', 'uint32'),
+    54: ('dhcp-server-identifier', 'ip'),
+    121: ('classless-static-routes', 'routes')
+}
 
 SSH_KEY_FILE = '/root/.ssh/authorized_keys'
 DEFAULT_DNS_SERVERS = ['8.8.8.8', '8.8.4.4']
@@ -62,11 +94,20 @@ DEFAULT_DISCOVERY_INTERFACE = '1.1'
 
 REMOVE_DHCP_LEASE_FILES = False
 
+# parsed lease files by path, as ((mtime, size, inode), leases)
+DHCP_LEASE_CACHE = {}
+
 HOSTNAME_SET = False
 NETWORKS_CONFIGURED = False
 
 FIRST_BOOT_FILE = '/var/run/cloudinit-complete'
 
+SYSTEM_FACTS_FILE = OUT_DIR + '/system_facts.json'
+DMI_UUID_FILE = '/sys/class/dmi/id/product_uuid'
+TMOS_VERSION_FILE = '/VERSION'
+BOOT_ID_FILE = '/proc/sys/kernel/random/boot_id'
+SYSTEM_FACTS = {}
+
 # because TMOS keeps moving CLI commands
 SYSCMDS = {
     'ansible-playbook': '/usr/local/bin/ansible-playbook',
@@ -201,8 +242,8 @@ def is_mgmt_default_gateway():
     return False
 
 
-def get_tmos_version():
-    """Get the TMOS version string"""
+def query_tmos_version():
+    """Get the TMOS version string from the CLI"""
     fnull = open(os.devnull, 'w')
     version = subprocess.Popen(
         "%s /VERSION | %s -i sequence | %s -d':' -f2 | %s '[A-Z]' '[a-z]' | %s -d '[:space:]'"
@@ -214,8 +255,8 @@ def get_tmos_version():
     return version
 
 
-def get_tmos_product():
-    """Get the TMOS product string"""
+def query_tmos_product():
+    """Get the TMOS product string from the CLI"""
     fnull = open(os.devnull, 'w')
     product = subprocess.Popen(
         "%s show sys version | %s Product | %s '{print $NF}'" %
@@ -226,8 +267,8 @@ def get_tmos_product():
     return product
 
 
-def get_dmi_uuid():
-    """Get the system UUID from DMI"""
+def query_dmi_uuid():
+    """Get the system UUID from the DMI CLI"""
     fnull = open(os.devnull, 'w')
     uuid = subprocess.Popen(
         "%s | %s -i UUID | %s -d':' -f2 | %s '[A-Z]' '[a-z]' | %s -d '[:space:]'"
@@ -239,6 +280,90 @@ def get_dmi_uuid():
     return uuid
 
 
+def read_system_file(path):
+    """Read a small system file, returning None when it is unavailable"""
+    try:
+        with open(path, 'r') as system_file:
+            return system_file.read()
+    except IOError:
+        return None
+
+
+def resolve_system_facts(boot_id):
+    """Resolve the immutable system facts from sysfs and /VERSION"""
+    facts = {'boot_id': boot_id}
+    dmi_uuid = read_system_file(DMI_UUID_FILE)
+    if dmi_uuid:
+        facts['dmi_uuid'] = ''.join(dmi_uuid.lower().split())
+    else:
+        facts['dmi_uuid'] = query_dmi_uuid()
+    version = {}
+    for line in (read_system_file(TMOS_VERSION_FILE) or '').splitlines():
+        if ':' in line:
+            (key, value) = line.split(':', 1)
+            version[key.strip().lower()] = value.strip()
+    if 'sequence' in version:
+        facts['tmos_version'] = ''.join(version['sequence'].lower().split())
+    else:
+        facts['tmos_version'] = query_tmos_version()
+    if version.get('product'):
+        facts['tmos_product'] = version['product'].split()[-1]
+    else:
+        facts['tmos_product'] = query_tmos_product()
+    return facts
+
+
+def get_system_facts():
+    """Get the immutable system facts, resolved once per boot
+
+    Facts are kept in memory and persisted to SYSTEM_FACTS_FILE so later
+    modules in the same boot reuse them. The kernel boot id invalidates
+    facts persisted during a previous boot.
+    """
+    boot_id = (read_system_file(BOOT_ID_FILE) or '').strip()
+    if SYSTEM_FACTS and SYSTEM_FACTS.get('boot_id') == boot_id:
+        return SYSTEM_FACTS
+    facts = None
+    if os.path.isfile(SYSTEM_FACTS_FILE):
+        try:
+            with open(SYSTEM_FACTS_FILE, 'r') as facts_file:
+                facts = json.load(facts_file)
+        except (IOError, ValueError) as err:
+            LOG.error('can not read system facts from %s - %s',
+                      SYSTEM_FACTS_FILE, err)
+    if not facts or not boot_id or facts.get('boot_id') != boot_id:
+        facts = resolve_system_facts(boot_id)
+        LOG.debug('resolved system facts: %s', facts)
+        # facts from a CLI which was not ready yet are not persisted
+        if boot_id and all(facts.values()):
+            try:
+                tmp_facts_file = SYSTEM_FACTS_FILE + '.tmp'
+                with open(tmp_facts_file, 'w') as facts_file:
+                    json.dump(facts, facts_file)
+                os.rename(tmp_facts_file, SYSTEM_FACTS_FILE)
+            except (IOError, OSError) as err:
+                LOG.error('can not persist system facts to %s - %s',
+                          SYSTEM_FACTS_FILE, err)
+    SYSTEM_FACTS.clear()
+    SYSTEM_FACTS.update(facts)
+    return SYSTEM_FACTS
+
+
+def get_tmos_version():
+    """Get the TMOS version string"""
+    return get_system_facts()['tmos_version']
+
+
+def get_tmos_product():
+    """Get the TMOS product string"""
+    return get_system_facts()['tmos_product']
+
+
+def get_dmi_uuid():
+    """Get the system UUID from DMI"""
+    return get_system_facts()['dmi_uuid']
+
+
 def get_hostname():
     """Get the system hostname"""
     return socket.gethostname()
@@ -502,45 +627,466 @@ def dhcp_lease_dir_exists():
         os.makedirs(DHCP_LEASE_DIR)
 
 
-def make_dhcp4_request(interface, timeout=120):
-    """Makes DHCPv4 queries out a linux link device"""
+def write_dhclient_conf():
+    """Writes the dhclient configuration for TMM link queries once"""
     dhcp_lease_dir_exists()
-    tmp_conf_file = DHCP_LEASE_DIR + '/dhclient.conf'
-    lease_file = DHCP_LEASE_DIR + '/' + interface + '.lease'
-    tmp_lease_file = '/tmp/' + interface + '.lease'
-    fnull = open(os.devnull, 'w')
-    dhclient_cf = open(tmp_conf_file, 'w')
-    dhclient_cf.write(
-        "\nrequest subnet-mask, broadcast-address, time-offset, routers,\n")
-    dhclient_cf.write(
-        "        domain-name, domain-name-servers, domain-search, host-name,\n"
-    )
-    dhclient_cf.write(
-        "        root-path, interface-mtu, classless-static-routes;\n")
-    dhclient_cf.close()
-    if os.path.isfile(lease_file):
-        del_file(lease_file)
-    subprocess.call([SYSCMDS['pkill'], 'dhclient'], stdout=fnull)
-    subprocess.call([SYSCMDS['ip'], 'link', 'set', interface, 'up'],
-                    stdout=fnull)
-    subprocess.call([
-        SYSCMDS['dhclient'], '-lf', tmp_lease_file, '-cf', tmp_conf_file, '-1',
-        '-timeout',
-        str(timeout), '-pf', '/tmp/dhclient.' + interface + '.pid', '-sf',
-        SYSCMDS['echo'], interface
-    ],
-        stdout=fnull)
-    if os.path.getsize(tmp_lease_file) > 0:
-        copy(tmp_lease_file, lease_file)
-        subprocess.call([SYSCMDS['pkill'], 'dhclient'], stdout=fnull)
-        del_file('/tmp/dhclient.' + interface + '.pid')
+    if os.path.isfile(DHCLIENT_CONF_FILE):
+        with open(DHCLIENT_CONF_FILE, 'r') as dhclient_cf:
+            if dhclient_cf.read() == DHCLIENT_CONF:
+                return DHCLIENT_CONF_FILE
+    with open(DHCLIENT_CONF_FILE, 'w') as dhclient_cf:
+        dhclient_cf.write(DHCLIENT_CONF)
+    return DHCLIENT_CONF_FILE
+
+
+class DhcpClientManager(object):
+    """Runs and terminates the dhclient processes for TMM link queries
+
+    Each dhclient runs in the foreground, so the manager holds the
+    process itself and terminates it once its lease is written instead
+    of chasing a daemonized child. Stale clients left by an earlier run
+    are only signalled when they still own their pid file. Other dhclient
+    processes on the system, like the one serving the mgmt interface, are
+    left running.
+    """
+
+    def __init__(self):
+        self.clients = {}
+
+    def start(self, interface, timeout=120):
+        """Starts a dhclient query out of a linux link device"""
+        if interface in self.clients:
+            self.stop(interface)
+        conf_file = write_dhclient_conf()
+        lease_file = DHCP_LEASE_DIR + '/' + interface + '.lease'
+        tmp_lease_file = '/tmp/' + interface + '.lease'
+        pid_file = '/tmp/dhclient.' + interface + '.pid'
+        fnull = open(os.devnull, 'w')
+        if os.path.isfile(lease_file):
+            del_file(lease_file)
         del_file(tmp_lease_file)
+        self.stop_pid_file(pid_file)
+        subprocess.call([SYSCMDS['ip'], 'link', 'set', interface, 'up'],
+                        stdout=fnull)
+        LOG.debug('starting DHCPv4 request on %s', interface)
+        dhclient = subprocess.Popen([
+            SYSCMDS['dhclient'], '-d', '-lf', tmp_lease_file, '-cf',
+            conf_file, '-1', '-timeout',
+            str(timeout), '-pf', pid_file, '-sf', SYSCMDS['echo'], interface
+        ],
+            stdout=fnull,
+            stderr=fnull)
+        self.clients[interface] = {
+            'process': dhclient,
+            'lease_file': lease_file,
+            'tmp_lease_file': tmp_lease_file,
+            'pid_file': pid_file
+        }
+
+    def collect(self, interface):
+        """Copies a completely written lease, returning success"""
+        client = self.clients[interface]
+        if not os.path.isfile(client['tmp_lease_file']):
+            return False
+        with open(client['tmp_lease_file'], 'r') as lease_fh:
+            if not lease_fh.read().rstrip().endswith('}'):
+                return False
+        LOG.debug('DHCPv4 lease obtained on %s', interface)
+        copy(client['tmp_lease_file'], client['lease_file'])
         return True
-    else:
-        subprocess.call([SYSCMDS['pkill'], 'dhclient'], stdout=fnull)
-        del_file('/tmp/dhclient.' + interface + '.pid')
-        del_file(tmp_lease_file)
-    return False
+
+    def stop(self, interface):
+        """Terminates the dhclient started for a linux link device"""
+        client = self.clients.pop(interface, None)
+        if not client:
+            return
+        if client['process'].poll() is None:
+            client['process'].terminate()
+            client['process'].wait()
+        self.stop_pid_file(client['pid_file'])
+        del_file(client['tmp_lease_file'])
+
+    def stop_all(self):
+        """Terminates every dhclient started by this manager"""
+        for interface in list(self.clients):
+            self.stop(interface)
+
+    @staticmethod
+    def stop_pid_file(pid_file):
+        """Terminates a stale dhclient if it still owns its pid file"""
+        if not os.path.isfile(pid_file):
+            return
+        try:
+            with open(pid_file, 'r') as pid_fh:
+                pid = int(pid_fh.read().strip())
+            with open('/proc/%d/cmdline' % pid, 'r') as cmdline_fh:
+                cmdline = cmdline_fh.read().split('\0')
+            if pid_file in cmdline:
+                os.kill(pid, signal.SIGTERM)
+        except (ValueError, IOError, OSError) as err:
+            LOG.debug('no dhclient to stop for %s - %s', pid_file, err)
+        del_file(pid_file)
+
+    def request(self, interfaces, timeout=120):
+        """Makes concurrent DHCPv4 queries out of many linux link devices
+
+        Leases are copied into the lease directory as each dhclient writes
+        one, then that dhclient is terminated. Clients still waiting when
+        the timeout expires are terminated too.
+        Returns a dictionary of interface names to True when a lease was
+        obtained.
+        """
+        leases = {}
+        try:
+            for interface in interfaces:
+                if interface:
+                    self.start(interface, timeout)
+                    leases[interface] = False
+            end_time = time.time() + timeout
+            while self.clients:
+                expired = time.time() > end_time
+                for interface in list(self.clients):
+                    if self.collect(interface):
+                        leases[interface] = True
+                        self.stop(interface)
+                    elif self.clients[interface]['process'].poll() \
+                            is not None:
+                        LOG.warn('dhclient gave up on %s', interface)
+                        self.stop(interface)
+                    elif expired:
+                        LOG.warn('DHCPv4 request on %s timed out', interface)
+                        self.stop(interface)
+                if self.clients:
+                    time.sleep(DHCP_POLL_INTERVAL)
+        finally:
+            self.stop_all()
+        return leases
+
+
+def make_dhcp4_request(interface, timeout=120):
+    """Makes DHCPv4 queries out a linux link device"""
+    return DhcpClientManager().request([interface], timeout)[interface]
+
+
+def make_dhcp4_requests(interfaces, timeout=120):
+    """Makes concurrent DHCPv4 queries out of many linux link devices"""
+    return DhcpClientManager().request(interfaces, timeout)
+
+
+def dhcp4_packet(message_type, mac, xid, requested_ip=None, server_id=None):
+    """Builds a broadcast DHCPv4 client packet"""
+    chaddr = ''.join([chr(int(octet, 16)) for octet in mac.split(':')])
+    packet = struct.pack('!BBBBIHH4s4s4s4s16s64s128sI', 1, 1, 6, 0, xid, 0,
+                         0x8000, '\0' * 4, '\0' * 4, '\0' * 4, '\0' * 4,
+                         chaddr, '', '', DHCP_MAGIC_COOKIE)
+    options = [(53, chr(message_type)),
+               (55, ''.join([chr(code) for code in DHCP4_OPTIONS]))]
+    if requested_ip:
+        options.append((50, socket.inet_aton(requested_ip)))
+    if server_id:
+        options.append((54, socket.inet_aton(server_id)))
+    for (code, value) in options:
+        packet += chr(code) + chr(len(value)) + value
+    return packet + chr(255)
+
+
+def parse_dhcp4_packet(packet, xid):
+    """Parses a DHCPv4 server reply into its address and raw options"""
+    if len(packet) < 240:
+        return None
+    (op, xid_reply, yiaddr,
+     cookie) = (ord(packet[0]), struct.unpack('!I', packet[4:8])[0],
+                socket.inet_ntoa(packet[16:20]),
+                struct.unpack('!I', packet[236:240])[0])
+    if op != 2 or xid_reply != xid or cookie != DHCP_MAGIC_COOKIE:
+        return None
+    options = {}
+    index = 240
+    while index < len(packet):
+        code = ord(packet[index])
+        if code == 255:
+            break
+        if code == 0:
+            index += 1
+            continue
+        if index + 1 >= len(packet):
+            break
+        length = ord(packet[index + 1])
+        # long options may be split across several instances
+        options[code] = options.get(code, '') + \
+            packet[index + 2:index + 2 + length]
+        index += 2 + length
+    return {'yiaddr': yiaddr, 'options': options}
+
+
+def format_dhcp4_routes(value):
+    """Formats option 121 classless routes the way dhclient does"""
+    routes = []
+    index = 0
+    while index < len(value):
+        width = ord(value[index])
+        significant = (width + 7) // 8
+        network = [str(ord(octet))
+                   for octet in value[index + 1:index + 1 + significant]]
+        gateway = socket.inet_ntoa(value[index + 1 + significant:index + 5 +
+                                         significant])
+        routes.append('.'.join([str(width)] + network) + ' ' + gateway)
+        index += 5 + significant
+    return ','.join(routes)
+
+
+def format_dhcp4_options(reply):
+    """Formats DHCPv4 reply options like process_dhcp4_lease returns them"""
+    return_data = {'fixed-address': reply['yiaddr']}
+    for (code, value) in reply['options'].items():
+        if code not in DHCP4_OPTIONS:
+            continue
+        (name, value_type) = DHCP4_OPTIONS[code]
+        try:
+            if value_type == 'ip':
+                return_data[name] = socket.inet_ntoa(value[:4])
+            elif value_type == 'ips':
+                return_data[name] = ','.join([
+                    socket.inet_ntoa(value[index:index + 4])
+                    for index in range(0, len(value) - 3, 4)
+                ])
+            elif value_type == 'uint16':
+                return_data[name] = str(struct.unpack('!H', value[:2])[0])
+            elif value_type == 'uint32':
+                return_data[name] = str(struct.unpack('!I', value[:4])[0])
+            elif value_type == 'routes':
+                return_data[name] = format_dhcp4_routes(value)
+            else:
+                return_data[name] = value.replace('\0', '')
+        except (struct.error, socket.error) as err:
+            LOG.error('invalid DHCPv4 option %d - %s', code, err)
+    return return_data
+
+
+def open_dhcp4_socket(interface):
+    """Opens a DHCPv4 client UDP socket bound to a linux link device"""
+    dhcp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    dhcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    dhcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    dhcp_socket.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE,
+                           interface + '\0')
+    dhcp_socket.bind(('', DHCP_CLIENT_PORT))
+    dhcp_socket.setblocking(0)
+    return dhcp_socket
+
+
+def request_dhcp4_leases(interfaces, timeout=120):
+    """Makes concurrent DHCPv4 queries without spawning dhclient
+
+    Runs the DISCOVER, OFFER, REQUEST and ACK exchange for every link
+    device at once from a single select loop, retransmitting until each
+    interface is bound or the timeout expires. Returns a dictionary of
+    interface names to the lease options, in the format returned by
+    process_dhcp4_lease, or None when no lease was obtained.
+    """
+    fnull = open(os.devnull, 'w')
+    clients = {}
+    leases = {}
+    for interface in interfaces:
+        if not interface:
+            continue
+        leases[interface] = None
+        try:
+            subprocess.call([SYSCMDS['ip'], 'link', 'set', interface, 'up'],
+                            stdout=fnull)
+            with open('/sys/class/net/%s/address' % interface) as mac_file:
+                mac = mac_file.read().strip()
+            clients[interface] = {
+                'socket': open_dhcp4_socket(interface),
+                'mac': mac,
+                'xid': random.getrandbits(32),
+                'state': 'discover',
+                'offer': None,
+                'retransmit': 0
+            }
+        except (IOError, socket.error) as err:
+            LOG.error('can not make DHCPv4 request on %s - %s', interface,
+                      err)
+    end_time = time.time() + timeout
+    try:
+        while clients and time.time() < end_time:
+            now = time.time()
+            for interface in clients:
+                client = clients[interface]
+                if now < client['retransmit']:
+                    continue
+                if client['state'] == 'discover':
+                    packet = dhcp4_packet(1, client['mac'], client['xid'])
+                else:
+                    packet = dhcp4_packet(3, client['mac'], client['xid'],
+                                          client['offer']['yiaddr'],
+                                          client['offer']['server_id'])
+                LOG.debug('sending DHCPv4 %s on %s', client['state'],
+                          interface)
+                try:
+                    client['socket'].sendto(
+                        packet, ('255.255.255.255', DHCP_SERVER_PORT))
+                except socket.error as err:
+                    LOG.error('DHCPv4 send failed on %s - %s', interface, err)
+                client['retransmit'] = now + DHCP_RETRANSMIT_INTERVAL
+            sockets = dict([(clients[interface]['socket'], interface)
+                            for interface in clients])
+            wait = min([clients[interface]['retransmit']
+                        for interface in clients] + [end_time]) - time.time()
+            readable = select.select(sockets.keys(), [], [], max(wait, 0))[0]
+            for dhcp_socket in readable:
+                interface = sockets[dhcp_socket]
+                client = clients[interface]
+                try:
+                    reply = parse_dhcp4_packet(dhcp_socket.recv(4096),
+                                               client['xid'])
+                except socket.error:
+                    continue
+                if not reply or 53 not in reply['options']:
+                    continue
+                message_type = ord(reply['options'][53][0])
+                if message_type == 2 and client['state'] == 'discover' \
+                        and 54 in reply['options']:
+                    LOG.debug('DHCPv4 offer of %s on %s', reply['yiaddr'],
+                              interface)
+                    reply['server_id'] = socket.inet_ntoa(
+                        reply['options'][54])
+                    client['offer'] = reply
+                    client['state'] = 'request'
+                    client['retransmit'] = 0
+                elif message_type == 5 and client['state'] == 'request':
+                    LOG.debug('DHCPv4 lease of %s obtained on %s',
+                              reply['yiaddr'], interface)
+                    leases[interface] = format_dhcp4_options(reply)
+                    client['socket'].close()
+                    del clients[interface]
+                elif message_type == 6 and client['state'] == 'request':
+                    LOG.warn('DHCPv4 request on %s refused, restarting',
+                             interface)
+                    client['xid'] = random.getrandbits(32)
+                    client['state'] = 'discover'
+                    client['retransmit'] = 0
+    finally:
+        for interface in clients:
+            LOG.warn('DHCPv4 request on %s timed out', interface)
+            clients[interface]['socket'].close()
+    return leases
+
+
+def tokenize_dhcp4_leases(lease_text):
+    """Splits dhclient v4 lease file text into words, strings and symbols"""
+    tokens = []
+    index = 0
+    while index < len(lease_text):
+        char = lease_text[index]
+        if char.isspace():
+            index += 1
+        elif char == '#':
+            end = lease_text.find('\n', index)
+            index = len(lease_text) if end < 0 else end
+        elif char in '{};':
+            tokens.append(char)
+            index += 1
+        elif char == '"':
+            value = ''
+            index += 1
+            while index < len(lease_text) and lease_text[index] != '"':
+                if lease_text[index] == '\\':
+                    index += 1
+                value += lease_text[index:index + 1]
+                index += 1
+            tokens.append(('string', value))
+            index += 1
+        else:
+            start = index
+            while index < len(lease_text) and \
+                    not lease_text[index].isspace() and \
+                    lease_text[index] not in '{};"#':
+                index += 1
+            tokens.append(lease_text[start:index])
+    return tokens
+
+
+def parse_dhcp4_lease_expiry(words):
+    """Converts a dhclient v4 lease expire statement to epoch seconds"""
+    if words and words[0] == 'never':
+        return float('inf')
+    if len(words) > 1 and words[0] == 'epoch':
+        return float(words[1])
+    if len(words) > 2:
+        # dhclient writes times in UTC as: weekday YYYY/MM/DD HH:MM:SS
+        return float(
+            calendar.timegm(
+                time.strptime(words[1] + ' ' + words[2],
+                              '%Y/%m/%d %H:%M:%S')))
+    return None
+
+
+def parse_dhcp4_leases(lease_file):
+    """Parses every lease block of a dhclient v4 lease file
+
+    Each lease is returned as a dictionary of its statements and options,
+    with quoted values unquoted and the expiry in epoch seconds. Results
+    are memoized by the lease file's mtime, size and inode.
+    """
+    stat = os.stat(lease_file)
+    cache_key = (stat.st_mtime, stat.st_size, stat.st_ino)
+    if lease_file in DHCP_LEASE_CACHE and \
+            DHCP_LEASE_CACHE[lease_file][0] == cache_key:
+        return DHCP_LEASE_CACHE[lease_file][1]
+    with open(lease_file, 'r') as lease_fh:
+        tokens = tokenize_dhcp4_leases(lease_fh.read())
+    leases = []
+    lease = None
+    depth = 0
+    statement = []
+    for token in tokens:
+        if token == '{':
+            if depth == 0 and statement == ['lease']:
+                lease = {}
+            depth += 1
+            statement = []
+        elif token == '}':
+            depth -= 1
+            if depth == 0 and lease is not None:
+                leases.append(lease)
+                lease = None
+            statement = []
+        elif token == ';':
+            if lease is not None and depth == 1 and statement:
+                words = [word[1] if isinstance(word, tuple) else word
+                         for word in statement]
+                if words[0] == 'option' and len(words) > 2:
+                    lease[words[1]] = ' '.join(words[2:])
+                elif words[0] == 'expire':
+                    try:
+                        lease['expire'] = parse_dhcp4_lease_expiry(words[1:])
+                    except ValueError as err:
+                        LOG.error('invalid lease expiry in %s - %s',
+                                  lease_file, err)
+                elif len(words) > 1:
+                    lease[words[0]] = ' '.join(words[1:])
+            statement = []
+        else:
+            statement.append(token)
+    DHCP_LEASE_CACHE[lease_file] = (cache_key, leases)
+    return leases
+
+
+def get_dhcp4_lease(lease_file):
+    """Returns the latest valid lease of a dhclient v4 lease file
+
+    The lease with a fixed address expiring last wins, and dhclient
+    appends renewed leases so a later lease wins an equal expiry.
+    """
+    latest = None
+    for lease in parse_dhcp4_leases(lease_file):
+        if 'fixed-address' not in lease:
+            continue
+        if latest is None or lease.get('expire', 0) >= latest.get(
+                'expire', 0):
+            latest = lease
+    return latest
 
 
 def process_dhcp4_lease(interface, return_options=None):
@@ -556,21 +1102,12 @@ def process_dhcp4_lease(interface, return_options=None):
     if os.path.isfile(interface):
         lease_file = interface
 
-    for line in open(lease_file):
-        if 'fixed-address' not in return_data and "fixed-address" in line:
-            # format: fixed-address 1.1.1.110;
-            test_fixed_address = 'fixed-address '
-            lidx = line.index(test_fixed_address)
-            return_data['fixed-address'] = \
-                line[lidx + len(test_fixed_address):].replace(';\n', '')
+    lease = get_dhcp4_lease(lease_file)
+    if lease:
+        return_data['fixed-address'] = lease['fixed-address']
         for option in return_options:
-            test_option = option + ' '
-            if (option not in return_data) and (test_option in line):
-                # format: option routers 1.1.1.1;
-                lidx = line.index(test_option)
-                return_data[option] = \
-                    line[lidx + len(test_option):].replace(
-                        ';\n', '').replace('"', '').replace("'", '')
+            if option in lease:
+                return_data[option] = lease[option]
     return return_data
 
 
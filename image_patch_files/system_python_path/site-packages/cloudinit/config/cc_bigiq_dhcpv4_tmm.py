@@ -42,6 +42,7 @@ device_discovery_interface - implicitly define the device discovery interface.
 default_route_interface - implicitly defint the TMOS default route interface.
 license_key - optional license key for AUTOMATIC license registration for the BIG-IQ 
 node_type - optional BIG-IQ type, options are cm or dcd, default is cm
+native_dhcp - query TMM interfaces without spawning dhclient, default is False
 
 #cloud-config
 bigiq_dhcpv4_tmm:
@@ -149,7 +150,8 @@ def resolve_resources(rd_enabled=True,
                       default_route_interface=None,
                       device_discovery_interface=None,
                       inject_routes=True,
-                      dhcp_timeout=120):
+                      dhcp_timeout=120,
+                      native_dhcp=False):
     """Resolve the resource provisioning dataset from metadata"""
     do_declaration = None
     if default_route_interface:
@@ -208,7 +210,14 @@ def resolve_resources(rd_enabled=True,
     except Exception as err:
         LOG.error('exception in processing mgmt DHCPv4 lease file: %s', err)
     bigiq_onboard_utils.force_tmm_down()
-    for interface in get_linux_interfaces():
+    interfaces = get_linux_interfaces()
+    if native_dhcp:
+        leases = bigiq_onboard_utils.request_dhcp4_leases(
+            interfaces, dhcp_timeout)
+    else:
+        leases = bigiq_onboard_utils.make_dhcp4_requests(
+            interfaces, dhcp_timeout)
+    for interface in interfaces:
         if interface:
             int_index = int(interface[3:])
             tmm_interface_name = '1.' + str(int_index)
@@ -225,10 +234,13 @@ def resolve_resources(rd_enabled=True,
             }
             s_ip = s_nm = s_gw = s_routes = None
             try:
-                if bigiq_onboard_utils.make_dhcp4_request(
-                        interface, dhcp_timeout):
+                interface_data = None
+                if native_dhcp:
+                    interface_data = leases.get(interface)
+                elif leases.get(interface):
                     interface_data = bigiq_onboard_utils.process_dhcp4_lease(
                         interface)
+                if interface_data:
                     if 'fixed-address' in interface_data:
                         s_ip = interface_data['fixed-address']
                     if 'subnet-mask' in interface_data:
@@ -756,6 +768,9 @@ def handle(name, userdata, cloud, log, args):
         inject_routes = True
         if 'inject_routes' in userdata[tag]:
             inject_routes = bool(userdata[tag]['inject_routes'])
+        native_dhcp = False
+        if 'native_dhcp' in userdata[tag]:
+            native_dhcp = bool(userdata[tag]['native_dhcp'])
         license_key = None
         if 'license_key' in userdata[tag]:
             license_key = userdata[tag]['license_key']
@@ -777,7 +792,8 @@ def handle(name, userdata, cloud, log, args):
         #                                             parts[1].strip())
         resources = resolve_resources(rd_enabled, default_route_interface,
                                       device_discovery_interface,
-                                      inject_routes, dhcp_timeout)
+                                      inject_routes, dhcp_timeout,
+                                      native_dhcp)
         LOG.debug('resolved config resources: %s', resources)
         create_onboard_artifacts(resources, license_key, node_type,
                                  post_onboard_commands)